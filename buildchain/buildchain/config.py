@@ -11,7 +11,7 @@ import os
 import shlex
 import enum
 
-from typing import Tuple
+from typing import Optional, Tuple
 from pathlib import Path
 
 from buildchain import ROOT
@@ -29,6 +29,23 @@ if not BUILD_ROOT.is_absolute():
     BUILD_ROOT = ROOT/BUILD_ROOT
 BUILD_ROOT = BUILD_ROOT.resolve()
 
+# Persistent cache of the pulled container images (empty to disable).
+_IMAGE_CACHE_DIR : str = os.getenv(
+    'IMAGE_CACHE_DIR', str(Path.home()/'.cache'/PROJECT_NAME.lower()/'images')
+)
+IMAGE_CACHE_DIR : Optional[Path] = Path(
+    _IMAGE_CACHE_DIR
+).expanduser().resolve() if _IMAGE_CACHE_DIR else None
+# Maximum size of the image cache, in GiB.
+IMAGE_CACHE_MAX_SIZE : int = int(
+    float(os.getenv('IMAGE_CACHE_MAX_SIZE', '20')) * 1024**3
+)
+
+# Maximum number of concurrent image pulls from the registries.
+PULL_CONCURRENCY : int = int(os.getenv('PULL_CONCURRENCY', '4'))
+# Maximum number of attempts to pull an image from its registry.
+PULL_ATTEMPTS : int = int(os.getenv('PULL_ATTEMPTS', '3'))
+
 # Vagrant configuration.
 VAGRANT_PROVIDER : str = os.getenv('VAGRANT_PROVIDER', 'virtualbox')
 _DEFAULT_VAGRANT_UP_ARGS : str = ' '.join((
@@ -53,7 +70,6 @@ class ExtCommand(enum.Enum):
     """External commands used by the build chain."""
 
     GIT      = os.getenv('GIT_BIN',      'git')
-    HARDLINK = os.getenv('HARDLINK_BIN', 'hardlink')
     MKISOFS  = os.getenv('MKISOFS_BIN',  'mkisofs')
     SKOPEO   = os.getenv('SKOPEO_BIN',   'skopeo')
     VAGRANT  = os.getenv('VAGRANT_BIN',  'vagrant')
@@ -31,6 +31,8 @@ ISO_ROOT : Path = config.BUILD_ROOT/'root'
 REPO_ROOT : Path = ISO_ROOT/'packages'
 # Root for the images on the ISO.
 ISO_IMAGE_ROOT : Path = ISO_ROOT/'images'
+# Content-addressed store of the images blobs (layers and configurations).
+IMAGE_BLOB_STORE : Path = config.BUILD_ROOT/'blobs'
 # Root for the packages that we build ourselves.
 PKG_ROOT : Path = config.BUILD_ROOT/'packages'
 # Root of the Vagrant environment folder.
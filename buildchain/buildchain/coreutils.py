@@ -4,40 +4,98 @@
 """Pure Python implementation of some core utilities."""
 
 
+import concurrent.futures
 import gzip as gzip_module
 import functools
 import hashlib
 import os
 import shutil
+import threading
 from pathlib import Path
-from typing import Iterator, Sequence
+from typing import BinaryIO, Iterator, Optional, Sequence
 
 
 # Buffer size (8 Mio).
 BUFSIZE : int = 8 * (1024 * 1024)
 
+# Per-thread read buffers used for hashing.
+_BUFFERS : threading.local = threading.local()
 
-def sha256sum(input_files: Sequence[Path], output_file: Path) -> None:
+
+def sha256_file(path: Path) -> str:
+    """Compute the SHA256 digest of a file.
+
+    The file is read into a buffer reused across calls (one per thread), to
+    avoid allocating a new chunk for each read.
+
+    Arguments:
+        path: path to the file to hash
+
+    Returns:
+        the hexadecimal digest of the file
+    """
+    buffer = getattr(_BUFFERS, 'buffer', None)
+    if buffer is None:
+        buffer = _BUFFERS.buffer = memoryview(bytearray(BUFSIZE))
+    hasher = hashlib.sha256()
+    with path.open('rb', buffering=0) as fp:
+        while True:
+            size = fp.readinto(buffer)  # type: ignore
+            if not size:
+                break
+            hasher.update(buffer[:size])
+    return hasher.hexdigest()
+
+
+def sha256_tee(source: BinaryIO, destination: Path) -> str:
+    """Copy a stream into a file, computing its SHA256 digest on the fly.
+
+    This allows to checksum the output of a command (read from a pipe) while
+    writing it, instead of reading the written file again.
+
+    Arguments:
+        source:      binary stream to copy (read until EOF)
+        destination: path to the file to write
+
+    Returns:
+        the hexadecimal digest of the copied data
+    """
+    buffer = memoryview(bytearray(BUFSIZE))
+    hasher = hashlib.sha256()
+    with destination.open('wb', buffering=0) as fp:
+        while True:
+            size = source.readinto(buffer)  # type: ignore
+            if not size:
+                break
+            hasher.update(buffer[:size])
+            fp.write(buffer[:size])
+    return hasher.hexdigest()
+
+
+def sha256sum(
+    input_files: Sequence[Path],
+    output_file: Path,
+    workers: Optional[int]=None,
+) -> None:
     """Compute the SHA256 digest of files.
 
     The digests are written into an output file, respecting the sha256sum format
     (i.e. each line contains a digest followed by two spaces and then the
     filename).
 
+    Files are hashed concurrently, in a pool of threads (hashlib releases the
+    GIL while hashing).
+
     Arguments:
         input_files: path to the files to hash
         output_file: path to the file that will contain the checksums
+        workers:     number of hashing threads
     """
-    digests = []
-    for filepath in input_files:
-        hasher = hashlib.sha256()
-        with filepath.open('rb', buffering=BUFSIZE) as fp:
-            for chunk in iter(functools.partial(fp.read, BUFSIZE), b''):
-                hasher.update(chunk)
-        digests.append(hasher.hexdigest())
-    with output_file.open('w', encoding='utf-8') as fp:
-        for filepath, digest in zip(input_files, digests):
-            fp.write('{}  {}\n'.format(digest, filepath.name))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        digests = pool.map(sha256_file, input_files)
+        with output_file.open('w', encoding='utf-8') as fp:
+            for filepath, digest in zip(input_files, digests):
+                fp.write('{}  {}\n'.format(digest, filepath.name))
 
 
 def gzip(input_file: Path, keep_input: bool=False, level: int=6) -> None:
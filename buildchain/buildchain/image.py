@@ -7,23 +7,24 @@ This module provides two services:
 - downloading a prebuilt image from a registry
 
 In either cases, those images are saved in a specific directory under the
-ISO's root.
+ISO's root, their blobs being hard links to a shared content-addressed store
+(so that layers common to several images are stored only once).
 
 Overview:
 
                                   ┌───────────┐
-                            ╱────>│pull:image1│───────     ┌─────────┐
-                 ┌────────┐╱      └───────────┘       ╲    │         │
-                 │        │       ┌───────────┐        ╲   │  dedup  │
-             ───>│  pull  │──────>│pull:image2│───────────>│  layers │
-            ╱    │        │       └───────────┘        ╱   │         │
-┌─────────┐╱     └────────┘╲      ┌───────────┐       ╱    └─────────┘
-│         │                 ╲────>│pull:image3│───────      ╱
-│  mkdir  │                       └───────────┘            ╱
-│         │                                               ╱
-└─────────┘╲     ┌────────┐                              ╱
-            ╲    │        │       ┌────────────┐        ╱
-             ───>│  build │──────>│build:image3│───────╱
+                            ╱────>│pull:image1│
+                 ┌────────┐╱      └───────────┘
+                 │        │       ┌───────────┐
+             ───>│  pull  │──────>│pull:image2│
+            ╱    │        │       └───────────┘
+┌─────────┐╱     └────────┘╲      ┌───────────┐
+│         │                 ╲────>│pull:image3│
+│  mkdir  │                       └───────────┘
+│         │
+└─────────┘╲     ┌────────┐
+            ╲    │        │       ┌────────────┐
+             ───>│  build │──────>│build:image3│
                  │        │       └────────────┘
                  └────────┘
 """
@@ -32,9 +33,9 @@ Overview:
 import datetime
 from typing import Iterator, Tuple
 
-from buildchain import config
 from buildchain import constants
 from buildchain import coreutils
+from buildchain import pull_scheduler
 from buildchain import targets
 from buildchain import types
 from buildchain import utils
@@ -48,7 +49,8 @@ def task_images() -> types.TaskDict:
             '_image_mkdir_root',
             '_image_pull',
             '_image_build',
-            '_image_dedup_layers',
+            '_image_pull_report',
+            '_image_gc_blobs',
         ],
     }
 
@@ -66,30 +68,38 @@ def task__image_pull() -> Iterator[types.TaskDict]:
         yield image.task
 
 
+def task__image_pull_report() -> types.TaskDict:
+    """Write the build report of the image pulls."""
+    return {
+        'title': lambda task: utils.title_with_target1('REPORT', task),
+        'actions': [pull_scheduler.write_report],
+        'targets': [pull_scheduler.REPORT_FILE],
+        'task_dep': ['_image_pull'],
+        'uptodate': [False],
+        'clean': True,
+    }
+
+
+def task__image_gc_blobs() -> types.TaskDict:
+    """Remove the unused blobs from the image blob store."""
+    return {
+        'title': lambda task: '{cmd: <{width}} {path}'.format(
+            cmd='GC', width=constants.CMD_WIDTH,
+            path=utils.build_relpath(constants.IMAGE_BLOB_STORE),
+        ),
+        'actions': [targets.image.gc_blob_store],
+        'task_dep': ['_image_pull', '_image_build'],
+        'uptodate': [False],
+        'clean': [(coreutils.rm_rf, [constants.IMAGE_BLOB_STORE])],
+    }
+
+
 def task__image_build() -> Iterator[types.TaskDict]:
     """Download the container images."""
     for image in TO_BUILD:
         yield image.task
 
 
-def task__image_dedup_layers() -> types.TaskDict:
-    """De-duplicate the images' layers with hard links."""
-    def show() -> str:
-        return '{cmd: <{width}} {path}'.format(
-            cmd='HARDLINK', width=constants.CMD_WIDTH,
-            path=utils.build_relpath(constants.ISO_IMAGE_ROOT)
-        )
-
-    task = targets.Target(
-        task_dep=['check_for:hardlink', '_image_pull', '_image_build']
-    ).basic_task
-    task['title']   = lambda _: show()
-    task['actions'] = [
-        [config.ExtCommand.HARDLINK.value, '-c', constants.ISO_IMAGE_ROOT]
-    ]
-    return task
-
-
 NGINX_IMAGE_VERSION : str = '1.15.8'
 NODE_IMAGE_VERSION : str = '10.16.0'
 
@@ -0,0 +1,177 @@
+# coding: utf-8
+
+
+"""Persistent cache of the container images pulled from remote registries.
+
+The cache lives outside of the build tree, so that it survives clean builds
+and can be shared between builds on the same machine.
+
+Its layout is the following:
+- `blobs/<hex digest>`: the image blobs (layers and configurations), shared
+  between the cached images;
+- `images/<hex digest>/`: the non-blob files of an image (`manifest.json`,
+  `version`), keyed by the digest of the image in its remote registry.
+
+The cache size is bounded: when it is exceeded, the least recently used blobs
+(based on their modification time, refreshed on each use) are evicted.
+"""
+
+
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import List, Optional, Set, Tuple
+
+from buildchain import config
+from buildchain import coreutils
+from buildchain.targets import image
+
+
+class ImageCache:
+    """A size-bounded, persistent, cache of container images."""
+
+    def __init__(self, root: Path, max_size: int):
+        """Initialize the cache.
+
+        Arguments:
+            root:     root directory of the cache
+            max_size: maximum size of the cached blobs, in bytes
+        """
+        self._root = root
+        self._max_size = max_size
+
+    @property
+    def blobs_dir(self) -> Path:
+        """Directory containing the cached blobs."""
+        return self._root/'blobs'
+
+    @property
+    def images_dir(self) -> Path:
+        """Directory containing the cached images."""
+        return self._root/'images'
+
+    def image_dir(self, digest: str) -> Path:
+        """Directory of the cached image with the given (remote) digest."""
+        return self.images_dir/digest.split(':', 1)[-1]
+
+    def restore(self, digest: str, destination: Path) -> bool:
+        """Restore a cached image into `destination`.
+
+        Arguments:
+            digest:      digest of the image in its remote registry
+            destination: image directory to populate
+
+        Returns:
+            True if the image was restored, False if it is not (or not
+            completely) cached.
+        """
+        image_dir = self.image_dir(digest)
+        try:
+            blobs = _manifest_blobs(image_dir/'manifest.json')
+        except (OSError, ValueError, KeyError):
+            return False
+        if not all((self.blobs_dir/blob).is_file() for blob in blobs):
+            return False
+
+        destination.mkdir(parents=True, exist_ok=True)
+        try:
+            for path in image_dir.iterdir():
+                coreutils.cp_file(path, destination/path.name)
+            for blob in blobs:
+                if (destination/blob).exists():
+                    (destination/blob).unlink()
+                _link_or_copy(self.blobs_dir/blob, destination/blob)
+                # Refresh the blob's position in the LRU order.
+                os.utime(self.blobs_dir/blob)
+        except OSError:
+            # The cache entry was evicted concurrently.
+            return False
+        return True
+
+    def store(self, digest: str, source: Path) -> None:
+        """Store an image directory in the cache, then enforce the size limit.
+
+        Arguments:
+            digest: digest of the image in its remote registry
+            source: image directory to store
+        """
+        self.blobs_dir.mkdir(parents=True, exist_ok=True)
+        self.images_dir.mkdir(parents=True, exist_ok=True)
+        staging = Path(tempfile.mkdtemp(dir=str(self.images_dir)))
+        try:
+            for path in source.iterdir():
+                if image.BLOB_NAME_RE.match(path.name):
+                    try:
+                        _link_or_copy(path, self.blobs_dir/path.name)
+                    except FileExistsError:
+                        os.utime(self.blobs_dir/path.name)
+                else:
+                    coreutils.cp_file(path, staging/path.name)
+            os.rename(staging, self.image_dir(digest))
+        except OSError:
+            # Already stored (concurrently), or the cache is unusable.
+            pass
+        finally:
+            coreutils.rm_rf(staging)
+        self.evict()
+
+    def evict(self) -> None:
+        """Evict the least recently used blobs exceeding the size limit."""
+        blobs: List[Tuple[float, int, Path]] = []
+        for path in self.blobs_dir.iterdir():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            blobs.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in blobs)
+        evicted : Set[str] = set()
+        for _, size, path in sorted(blobs):
+            if total <= self._max_size:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            evicted.add(path.name)
+            total -= size
+
+        if not evicted:
+            return
+        # Forget about the images which lost some of their blobs.
+        for image_dir in self.images_dir.iterdir():
+            try:
+                blobs_names = _manifest_blobs(image_dir/'manifest.json')
+            except (OSError, ValueError, KeyError):
+                continue
+            if evicted.intersection(blobs_names):
+                shutil.rmtree(image_dir, ignore_errors=True)
+
+
+def _manifest_blobs(manifest: Path) -> List[str]:
+    """Return the names of the blobs referenced by an image manifest."""
+    with manifest.open('r', encoding='utf-8') as fp:
+        data = json.load(fp)
+    return [
+        entry['digest'].split(':', 1)[-1]
+        for entry in [data['config']] + data['layers']
+    ]
+
+
+def _link_or_copy(source: Path, destination: Path) -> None:
+    """Hard link `source` to `destination`, or copy it across filesystems."""
+    try:
+        os.link(source, destination)
+    except FileExistsError:
+        raise
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+# The build-machine image cache (None if disabled).
+IMAGE_CACHE : Optional[ImageCache] = ImageCache(
+    config.IMAGE_CACHE_DIR, config.IMAGE_CACHE_MAX_SIZE
+) if config.IMAGE_CACHE_DIR is not None else None
@@ -6,10 +6,15 @@
 This module handles the creation of the final ISO, which involves:
 - creating the ISO's root
 - populating the ISO's tree
-- creating the ISO
-- computing the ISO's checksum
+- creating the ISO and computing its checksum (in a single pass: the output
+  of mkisofs is hashed while being written)
+- computing the checksums of the ISO's contents
 
-Overview:
+Those last two steps depend on the contents of the ISO's tree through a
+single Merkle-style digest of the tree (instead of a `file_dep` on each of
+its files), whose per-file digests are cached in the doit database.
+
+Overview (═══> is a pipe: the ISO is hashed while being written):
 
                                 ┌─────────────┐
                         ┌──────>│   images    │────────┐
@@ -17,7 +22,7 @@ Overview:
                         │       ┌─────────────┐        │
                 ┌────────┐ ╱───>│  packaging  │────╲   v
 ┌───────┐       │        │╱     └─────────────┘    ┌─────────┐    ┌──────────┐
-│ mkdir │──────>│populate│                         │ mkisofs │───>│ checksum │
+│ mkdir │──────>│populate│                         │ mkisofs │═══>│  sha256  │
 └───────┘       │        │╲     ┌─────────────┐    └─────────┘    └──────────┘
                 └────────┘ ╲───>│  salt_tree  │────╱   ^
                         │       └─────────────┘        │
@@ -29,20 +34,28 @@ Overview:
 
 import datetime as dt
 import socket
+import subprocess
 from pathlib import Path
-from typing import Sequence
+from typing import List, Optional, Sequence, Union
 
-import doit  # type: ignore
+from doit.exceptions import TaskError  # type: ignore
 
 from buildchain import config
 from buildchain import constants
 from buildchain import coreutils
 from buildchain import targets as helper
+from buildchain import tree_digest
 from buildchain import types
 from buildchain import utils
 
 
 ISO_FILE : Path = config.BUILD_ROOT/'{}.iso'.format(config.PROJECT_NAME.lower())
+ISO_CHECKSUM_FILE : Path = config.BUILD_ROOT/'SHA256SUM'
+ISO_CONTENTS_CHECKSUM_FILE : Path = config.BUILD_ROOT/'ISO_CONTENTS.SHA256SUM'
+# Content-based up-to-date check of the ISO tree (see `tree_digest`).
+ISO_TREE_DIGEST : tree_digest.TreeDigest = tree_digest.TreeDigest(
+    constants.ISO_ROOT
+)
 
 
 def task_iso() -> types.TaskDict:
@@ -179,11 +192,10 @@ def task__iso_generate_product_txt() -> types.TaskDict:
     }
 
 
-@doit.create_after(executed='populate_iso')  # type: ignore
 def task__iso_build() -> types.TaskDict:
-    """Create the ISO from the files in ISO_ROOT."""
+    """Create the ISO from the files in ISO_ROOT, and compute its digest."""
     mkisofs = [
-        config.ExtCommand.MKISOFS.value, '-output',  ISO_FILE,
+        config.ExtCommand.MKISOFS.value,
         '-quiet',
         '-rock',
         '-joliet',
@@ -200,27 +212,59 @@ def task__iso_build() -> types.TaskDict:
     doc = 'Create the ISO from the files in {}.'.format(
         utils.build_relpath(constants.ISO_ROOT)
     )
-    # Every file used for the ISO is a dependency.
-    depends = list(coreutils.ls_files_rec(constants.ISO_ROOT))
-    depends.append(constants.VERSION_FILE)
     return {
         'title': lambda task: utils.title_with_target1('MKISOFS', task),
         'doc': doc,
-        'actions': [mkisofs],
-        'targets': [ISO_FILE],
-        'file_dep': depends,
-        'task_dep': ['check_for:mkisofs', '_build_root', '_iso_mkdir_root'],
+        'actions': [(_mkisofs, [mkisofs, ISO_FILE, ISO_CHECKSUM_FILE])],
+        'targets': [ISO_FILE, ISO_CHECKSUM_FILE],
+        'file_dep': [constants.VERSION_FILE],
+        # Every file used for the ISO is a dependency (through the digest of
+        # the whole ISO_ROOT tree).
+        'uptodate': [ISO_TREE_DIGEST],
+        'task_dep': [
+            'check_for:mkisofs', '_build_root', '_iso_mkdir_root',
+            'populate_iso',
+        ],
         'clean': True,
     }
 
 
 def task__iso_digest() -> types.TaskDict:
-    """Compute the SHA256 digest of the ISO."""
-    return helper.Sha256Sum(
-        input_files=[ISO_FILE],
-        output_file=config.BUILD_ROOT/'SHA256SUM',
-        task_dep=['_iso_build']
-    ).task
+    """Compute the SHA256 digests of the files in ISO_ROOT."""
+    return {
+        'title': lambda task: utils.title_with_target1('SHA256SUM', task),
+        'actions': [
+            (ISO_TREE_DIGEST.write_manifest, [ISO_CONTENTS_CHECKSUM_FILE])
+        ],
+        'targets': [ISO_CONTENTS_CHECKSUM_FILE],
+        'uptodate': [ISO_TREE_DIGEST],
+        'task_dep': ['_build_root', '_iso_mkdir_root', 'populate_iso'],
+        'clean': True,
+    }
+
+
+def _mkisofs(
+    command: List[Union[str, Path]], iso_file: Path, checksum_file: Path
+) -> Optional[TaskError]:
+    """Run mkisofs, writing the ISO and its SHA256 digest in a single pass.
+
+    mkisofs writes the ISO on its standard output, which is hashed while
+    being written to `iso_file`: the ISO is never read back from the disk.
+    """
+    with subprocess.Popen(command, stdout=subprocess.PIPE) as proc:
+        assert proc.stdout is not None
+        digest = coreutils.sha256_tee(proc.stdout, iso_file)
+        # The output was read until EOF: wait for mkisofs to exit, so that an
+        # error happening at the very end is detected.
+        returncode = proc.wait()
+    if returncode != 0:
+        iso_file.unlink()
+        return TaskError(msg='mkisofs failed with exit code {}'.format(
+            returncode
+        ))
+    with checksum_file.open('w', encoding='utf-8') as fp:
+        fp.write('{}  {}\n'.format(digest, iso_file.name))
+    return None
 
 
 __all__ = utils.export_only_tasks(__name__)
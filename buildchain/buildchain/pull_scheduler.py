@@ -0,0 +1,173 @@
+# coding: utf-8
+
+
+"""Coordination of the container image pulls.
+
+Image pulls are doit tasks, which may run in parallel (`doit -n`). This
+module bounds the number of concurrent pulls from the registries (whatever
+the number of doit processes), retries transient failures with an
+exponential backoff, and records per-image metrics gathered in a JSON build
+report.
+
+The concurrency limit is implemented with a pool of lock files (one per
+slot), so that it works across the doit worker processes.
+"""
+
+
+import contextlib
+import fcntl
+import json
+import os
+import random
+import subprocess
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Union
+
+from buildchain import config
+from buildchain import constants
+
+
+# Directory holding the pull slots lock files.
+SLOTS_DIR : Path = config.BUILD_ROOT/'.pull-slots'
+# Directory holding the per-image metrics.
+METRICS_DIR : Path = config.BUILD_ROOT/'reports'/'pulls'
+# Path to the build report of the image pulls.
+REPORT_FILE : Path = config.BUILD_ROOT/'reports'/'image-pulls.json'
+
+# Delay between two attempts to get a pull slot, in seconds.
+SLOT_POLL_INTERVAL : float = 0.5
+
+# Identifier of the current build (this module is imported once by doit,
+# before forking its workers): only the metrics of this build are reported.
+RUN_ID : str = '{}-{}'.format(os.getpid(), time.time())
+
+
+@contextlib.contextmanager
+def pull_slot(concurrency: int=config.PULL_CONCURRENCY) -> Iterator[int]:
+    """Wait for one of the `concurrency` pull slots, and hold it."""
+    SLOTS_DIR.mkdir(parents=True, exist_ok=True)
+    while True:
+        for slot in range(concurrency):
+            with (SLOTS_DIR/'slot-{}.lock'.format(slot)).open('w') as fp:
+                try:
+                    fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                try:
+                    yield slot
+                finally:
+                    fcntl.flock(fp, fcntl.LOCK_UN)
+                return
+        time.sleep(SLOT_POLL_INTERVAL)
+
+
+def run_with_retries(
+    cmd: Sequence[Union[str, Path]],
+    attempts: int=config.PULL_ATTEMPTS,
+    base_delay: float=2,
+    max_delay: float=60,
+) -> int:
+    """Run a command, retrying with an exponential backoff on failure.
+
+    Arguments:
+        cmd:        command line to run
+        attempts:   maximum number of runs
+        base_delay: delay before the first retry, in seconds
+        max_delay:  upper bound of the delay between two runs, in seconds
+
+    Returns:
+        the number of runs
+
+    Raises:
+        subprocess.CalledProcessError: if the last run failed
+    """
+    delay = base_delay
+    for attempt in range(1, attempts + 1):
+        try:
+            subprocess.run(cmd, check=True)
+        except subprocess.CalledProcessError:
+            if attempt == attempts:
+                raise
+            time.sleep(random.uniform(0.5, 1.5) * min(delay, max_delay))
+            delay *= 2
+        else:
+            return attempt
+    raise ValueError('attempts must be at least 1')
+
+
+def record(
+    name: str,
+    version: str,
+    source: str,
+    start: float,
+    end: float,
+    size: int,
+    attempts: int=0,
+) -> None:
+    """Record the metrics of an image pull.
+
+    Arguments:
+        name:     image name
+        version:  image version
+        source:   where the image was retrieved from (`registry` or `cache`)
+        start:    timestamp of the start of the pull
+        end:      timestamp of the end of the pull
+        size:     size of the pulled image, in bytes
+        attempts: number of pull attempts from the registry
+    """
+    METRICS_DIR.mkdir(parents=True, exist_ok=True)
+    duration = end - start
+    metrics = {
+        'name': name,
+        'version': version,
+        'source': source,
+        'start': start,
+        'end': end,
+        'duration': duration,
+        'bytes': size,
+        'bytes_per_second': size / duration if duration > 0 else None,
+        'attempts': attempts,
+        'run': RUN_ID,
+    }
+    path = METRICS_DIR/'{}-{}.json'.format(name, version)
+    with path.open('w', encoding='utf-8') as fp:
+        json.dump(metrics, fp)
+
+
+def write_report(output: Path=REPORT_FILE) -> None:
+    """Gather the metrics of the image pulls in a JSON build report.
+
+    Only the images pulled by the current build are reported: the metrics
+    left by previous builds (e.g. of images which are now up-to-date, or no
+    longer part of the build) are removed.
+    """
+    images : List[Dict[str, Any]] = []
+    if METRICS_DIR.is_dir():
+        for path in sorted(METRICS_DIR.glob('*.json')):
+            with path.open('r', encoding='utf-8') as fp:
+                metrics = json.load(fp)
+            if metrics.get('run') == RUN_ID:
+                images.append(metrics)
+            else:
+                path.unlink()
+
+    start : Optional[float] = min(
+        (image['start'] for image in images), default=None
+    )
+    end : Optional[float] = max(
+        (image['end'] for image in images), default=None
+    )
+    total_bytes = sum(image['bytes'] for image in images)
+    wall_clock = end - start if start is not None and end is not None else 0
+    report = {
+        'version': constants.VERSION,
+        'concurrency': config.PULL_CONCURRENCY,
+        'images': images,
+        'total_bytes': total_bytes,
+        'wall_clock': wall_clock,
+        'bytes_per_second': total_bytes / wall_clock if wall_clock else None,
+    }
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with output.open('w', encoding='utf-8') as fp:
+        json.dump(report, fp, indent=2, sort_keys=True)
@@ -35,6 +35,7 @@ from typing import Any, Iterator, Tuple, Union
 
 from buildchain import config
 from buildchain import constants
+from buildchain import coreutils
 from buildchain import targets
 from buildchain import utils
 from buildchain import types
@@ -108,6 +109,7 @@ class StaticContainerRegistry(targets.AtomicTarget):
         server_root: str,
         name_prefix: str,
         destination: Path,
+        static_dir: str='_static',
         **kwargs: Any
     ):
         """Configure the static-container-registry script.
@@ -117,15 +119,23 @@ class StaticContainerRegistry(targets.AtomicTarget):
             server_root: where the image files will be stored on the web server
             context:     will prefix every container name
             destination: path to the nginx configuration file to write
+            static_dir:  directory of `root` where to write the tag lists and
+                         the catalog
 
         Keyword Arguments:
             They are passed to `Target` init method.
         """
-        kwargs['targets'] = [destination]
+        # The tag lists depend on the images, only the catalog is known.
+        catalog = root/static_dir/'catalog.json'
+        kwargs['targets'] = [
+            destination, catalog, catalog.with_suffix('.json.gz'),
+            root/container_registry.INDEX_FILE,
+        ]
         super().__init__(task_name=destination.name, **kwargs)
         self._img_root = root
         self._srv_root = server_root
         self._name_pfx = name_prefix
+        self._static_dir = static_dir
 
     @property
     def task(self) -> types.TaskDict:
@@ -134,6 +144,7 @@ class StaticContainerRegistry(targets.AtomicTarget):
             'title': self._show,
             'doc': 'Generate the nginx config to serve a container registry.',
             'actions': [self._run],
+            'clean': [self._clean],
         })
         return task
 
@@ -143,13 +154,35 @@ class StaticContainerRegistry(targets.AtomicTarget):
         return utils.title_with_target1('NGINX_CFG', task)
 
     def _run(self) -> None:
-        """Generate the nginx configuration."""
+        """Generate the nginx configuration (and the static files).
+
+        The index of the images is kept with the images, so that it's shipped
+        with them (and used when serving them with the static registry
+        container).
+        """
+        index_file = self._img_root/container_registry.INDEX_FILE
+        index = container_registry.load_index(index_file)
+        # Drop the tag lists of images which are no longer there.
+        coreutils.rm_rf(self._img_root/self._static_dir)
         with Path(self.targets[0]).open('w', encoding='utf-8') as fp:
             parts = container_registry.create_config(
-                self._img_root, self._srv_root, self._name_pfx, False
+                self._img_root, self._srv_root, self._name_pfx, False,
+                index=index, static_dir=self._static_dir
             )
             for part in parts:
                 fp.write(part)
+        container_registry.save_index(index, index_file)
+
+    def _clean(self) -> None:
+        """Remove the nginx configuration, the index and the static files."""
+        coreutils.rm_rf(self._img_root/self._static_dir)
+        for target in (
+            Path(self.targets[0]), self._img_root/container_registry.INDEX_FILE
+        ):
+            try:
+                target.unlink()
+            except FileNotFoundError:
+                pass
 
 
 PILLAR_FILES : Tuple[Union[Path, targets.AtomicTarget], ...] = (
@@ -330,6 +363,8 @@ SALT_FILES : Tuple[Union[Path, targets.AtomicTarget], ...] = (
     Path('salt/metalk8s/orchestrate/downgrade/init.sls'),
     Path('salt/metalk8s/orchestrate/downgrade/precheck.sls'),
     Path('salt/metalk8s/orchestrate/etcd.sls'),
+    Path('salt/metalk8s/orchestrate/etcd_maintenance.sls'),
+    Path('salt/metalk8s/orchestrate/upgrade/batch.sls'),
     Path('salt/metalk8s/orchestrate/upgrade/init.sls'),
     Path('salt/metalk8s/orchestrate/upgrade/precheck.sls'),
     Path('salt/metalk8s/orchestrate/register_etcd.sls'),
@@ -401,7 +436,9 @@ SALT_FILES : Tuple[Union[Path, targets.AtomicTarget], ...] = (
 
     Path('salt/_roster/kubernetes_nodes.py'),
 
+    Path('salt/_runners/metalk8s_certificates.py'),
     Path('salt/_runners/metalk8s_saltutil.py'),
+    Path('salt/_runners/metalk8s_upgrade.py'),
 
     Path('salt/_states/containerd.py'),
     Path('salt/_states/kubeconfig.py'),
@@ -413,6 +450,7 @@ SALT_FILES : Tuple[Union[Path, targets.AtomicTarget], ...] = (
     Path('salt/_states/metalk8s_package_manager.py'),
 
     Path('salt/_utils/pillar_utils.py'),
+    Path('salt/_utils/retry_utils.py'),
 
     targets.RemoteImage(
         registry=constants.GOOGLE_REGISTRY,
@@ -5,6 +5,8 @@
 
 
 import operator
+import os
+import re
 from typing import Any
 from pathlib import Path
 
@@ -14,6 +16,23 @@ from buildchain import coreutils
 from . import base
 
 
+# Name of the blob files in an image directory (hex digest of their content).
+BLOB_NAME_RE = re.compile(r'^[a-f0-9]{64}$')
+
+
+def gc_blob_store() -> None:
+    """Remove the blobs of the store that are no longer used by any image.
+
+    An entry whose link count is 1 is not linked from any image directory
+    anymore (e.g. the image was cleaned, or bumped to another version).
+    """
+    if not constants.IMAGE_BLOB_STORE.is_dir():
+        return
+    for path in constants.IMAGE_BLOB_STORE.iterdir():
+        if path.stat().st_nlink == 1:
+            path.unlink()
+
+
 class ContainerImage(base.AtomicTarget):
     """A container image."""
     def __init__(
@@ -66,6 +85,27 @@ class ContainerImage(base.AtomicTarget):
         """Create the image directory."""
         self.dirname.mkdir(parents=True, exist_ok=True)
 
+    def link_blobs(self) -> None:
+        """Store the image blobs in the shared, content-addressed, blob store.
+
+        Each blob of the image directory is replaced by a hard link to the
+        store entry with the same digest (the entry is created if missing), so
+        that blobs shared between images are stored only once.
+
+        Note that skopeo still writes every blob in the image directory before
+        it is linked: only the disk space is saved, not the writes.
+        """
+        constants.IMAGE_BLOB_STORE.mkdir(parents=True, exist_ok=True)
+        for path in self.dirname.iterdir():
+            if not BLOB_NAME_RE.match(path.name):
+                continue
+            stored = constants.IMAGE_BLOB_STORE/path.name
+            try:
+                os.link(path, stored)
+            except FileExistsError:
+                path.unlink()
+                os.link(stored, path)
+
     def clean(self) -> None:
         """Delete the image directory and its contents."""
         coreutils.rm_rf(self.dest_dir/self.name)
@@ -206,6 +206,7 @@ class LocalImage(image.ContainerImage):
             cmd.append('dir:{}'.format(str(self.dirname)))
             actions.append(self.mkdirs)
             actions.append(cmd)
+            actions.append(self.link_blobs)
         else:
             # If we don't save the image, at least we touch a file
             # (to keep track of the build).
@@ -12,11 +12,17 @@ All of these actions are done by a single task.
 
 import operator
 import os
+import subprocess
+import time
 from pathlib import Path
 from typing import Any, Optional, List
 
+from doit.exceptions import TaskError # type: ignore
+
 from buildchain import docker_command
 from buildchain import config
+from buildchain import image_cache
+from buildchain import pull_scheduler
 from buildchain import types
 
 from . import image
@@ -137,11 +143,43 @@ class RemoteImage(image.ContainerImage):
             })
         else:
             task.update({
-                'actions': [self.mkdirs, self._skopeo_copy()],
+                'actions': [self.mkdirs, self._pull, self.link_blobs],
                 'clean':   [self.clean],
             })
         return task
 
+    def _pull(self) -> Optional[TaskError]:
+        """Retrieve the image from the image cache, or from the registry.
+
+        Images pulled from the registry are then added to the image cache.
+        Pulls from the registry are throttled and retried by the pull
+        scheduler, and their metrics recorded for the build report.
+        """
+        start = time.time()
+        cache = image_cache.IMAGE_CACHE
+        if cache is not None and cache.restore(self.digest, self.dirname):
+            source, attempts = 'cache', 0
+        else:
+            source = 'registry'
+            try:
+                with pull_scheduler.pull_slot():
+                    start = time.time()
+                    attempts = pull_scheduler.run_with_retries(
+                        self._skopeo_copy()
+                    )
+            except subprocess.CalledProcessError as exc:
+                return TaskError(msg='failed to pull {}: {}'.format(
+                    self.fullname, exc
+                ))
+            if cache is not None:
+                cache.store(self.digest, self.dirname)
+        pull_scheduler.record(
+            name=self.name, version=self.version, source=source,
+            start=start, end=time.time(), attempts=attempts,
+            size=sum(path.stat().st_size for path in self.dirname.iterdir()),
+        )
+        return None
+
     def _skopeo_copy(self) -> List[str]:
         """Return the command line to execute skopeo copy."""
         cmd = [
@@ -0,0 +1,162 @@
+# coding: utf-8
+
+
+"""Content-based up-to-date check of directory trees.
+
+Listing every file of a large tree (e.g. the ISO root, with its thousands of
+image blobs and packages) as `file_dep` makes doit check each of them on
+every run. Instead, a task can use a `TreeDigest` as `uptodate` checker: the
+tree is summarized by a Merkle-style root digest (each directory is hashed
+from the names, modes and digests of its entries) and the task is up-to-date
+as long as this digest does not change.
+
+The SHA256 digests of the files are saved in the doit database, along with
+the other values of the task, keyed by their size, modification time and
+inode number: a file is hashed again only when one of them changes, so that
+checking an unchanged tree only costs a `stat` per file.
+"""
+
+
+import concurrent.futures
+import hashlib
+import os
+import stat
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from buildchain import coreutils
+from buildchain import types
+
+
+# Identity of a file content: size, modification time (ns) and inode number.
+FileKey = Tuple[int, int, int]
+
+
+class TreeDigest:
+    """A doit `uptodate` checker on the contents of a directory tree."""
+
+    def __init__(self, root: Path, workers: Optional[int]=None):
+        """Initialize the checker.
+
+        Arguments:
+            root:    root directory of the tree
+            workers: number of hashing threads
+        """
+        self._root = root
+        self._workers = workers
+        self._key = 'tree_digest:{}'.format(root)
+        # Digests known in this process (shared by the tasks using `self`).
+        self._known : Dict[FileKey, str] = {}
+        self._files : Optional[Dict[str, str]] = None
+
+    def __call__(self, task: types.Task, values: Dict[str, Any]) -> bool:
+        """Check if the tree is unchanged since the last run of `task`."""
+        previous = values.get(self._key) or {}
+        for entry in previous.get('files', {}).values():
+            self._known.setdefault(tuple(entry[:3]), entry[3])
+
+        stats = dict(_walk(self._root))
+        files = self._hash_files(stats)
+        root_digest = _merkle_root(self._root, stats, files)
+        self._files = {path: entry[3] for path, entry in files.items()}
+
+        task.value_savers.append(lambda: {
+            self._key: {'root': root_digest, 'files': files}
+        })
+        return bool(previous.get('root') == root_digest)
+
+    def write_manifest(self, output_file: Path) -> None:
+        """Write the digests of the files, in the sha256sum format.
+
+        The digests computed by the last check are used: the files are only
+        hashed if the tree was not checked (e.g. `doit --always-execute`).
+        """
+        if self._files is None:
+            files = self._hash_files(dict(_walk(self._root)))
+            self._files = {path: entry[3] for path, entry in files.items()}
+        with output_file.open('w', encoding='utf-8') as fp:
+            for path in sorted(self._files, key=Path):
+                fp.write('{}  {}\n'.format(self._files[path], path))
+
+    def _hash_files(
+        self, stats: Dict[str, os.stat_result]
+    ) -> Dict[str, List[Any]]:
+        """Return the `[size, mtime, inode, digest]` of the regular files.
+
+        Only the files which are not known yet are hashed; hard links to the
+        same file (e.g. image blobs) are hashed once.
+        """
+        files : Dict[str, List[Any]] = {}
+        pending : Dict[FileKey, List[str]] = {}
+        for path, stat_res in stats.items():
+            if not stat.S_ISREG(stat_res.st_mode):
+                continue
+            key = (stat_res.st_size, stat_res.st_mtime_ns, stat_res.st_ino)
+            files[path] = list(key) + [self._known.get(key)]
+            if files[path][3] is None:
+                pending.setdefault(key, []).append(path)
+
+        with concurrent.futures.ThreadPoolExecutor(self._workers) as pool:
+            digests = pool.map(
+                coreutils.sha256_file,
+                [self._root/paths[0] for paths in pending.values()]
+            )
+            for (key, paths), digest in zip(pending.items(), digests):
+                self._known[key] = digest
+                for path in paths:
+                    files[path][3] = digest
+        return files
+
+
+def _walk(root: Path) -> Iterator[Tuple[str, os.stat_result]]:
+    """Yield the relative path and status of every entry under `root`.
+
+    Symbolic links are not followed.
+    """
+    directories = ['']
+    while directories:
+        directory = directories.pop()
+        with os.scandir(os.path.join(str(root), directory)) as entries:
+            for entry in entries:
+                path = os.path.join(directory, entry.name)
+                yield path, entry.stat(follow_symlinks=False)
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(path)
+
+
+def _merkle_root(
+    root: Path,
+    stats: Dict[str, os.stat_result],
+    files: Dict[str, List[Any]],
+) -> str:
+    """Compute the root digest of a tree, from the digests of its files."""
+    children : Dict[str, List[str]] = {}
+    # Deepest entries first, so that directories are hashed after their
+    # children.
+    for path in sorted(
+        stats, key=lambda path: path.count(os.sep), reverse=True
+    ):
+        mode = stats[path].st_mode
+        if stat.S_ISDIR(mode):
+            kind, digest = 'tree', _hash_entries(children.pop(path, []))
+        elif stat.S_ISLNK(mode):
+            target = os.readlink(os.path.join(str(root), path))
+            kind, digest = 'link', hashlib.sha256(
+                os.fsencode(target)
+            ).hexdigest()
+        elif stat.S_ISREG(mode):
+            kind, digest = 'blob', files[path][3]
+        else:
+            continue
+        children.setdefault(os.path.dirname(path), []).append(
+            '{} {:o} {} {}'.format(
+                kind, stat.S_IMODE(mode), digest, os.path.basename(path)
+            )
+        )
+    return _hash_entries(children.get('', []))
+
+
+def _hash_entries(entries: List[str]) -> str:
+    """Hash the (sorted) entries of a directory."""
+    content = '\n'.join(sorted(entries))
+    return hashlib.sha256(os.fsencode(content)).hexdigest()
@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+
+"""Benchmark of the static-container-registry configuration generator.
+
+Synthesizes an image tree (many names and tags, sharing layers), then:
+- measures the generation of the nginx configuration (cold, then with a warm
+  digest index): duration, peak memory and output size;
+- serves the tree with a Python stand-in for nginx, honoring the generated
+  locations, and measures the latency of concurrent pulls (manifests, then
+  blobs).
+
+The results are written as JSON on the standard output.
+"""
+
+import argparse
+import concurrent.futures
+import hashlib
+import http.server
+import importlib
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.error
+import urllib.request
+
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+REGISTRY = importlib.import_module('static-container-registry')
+
+LAYER_MEDIA_TYPE = 'application/vnd.docker.image.rootfs.diff.tar.gzip'
+CONFIG_MEDIA_TYPE = 'application/vnd.docker.container.image.v1+json'
+
+
+def write_blob(directory, content):
+    digest = hashlib.sha256(content).hexdigest()
+    with open(os.path.join(directory, digest), 'wb') as fd:
+        fd.write(content)
+    return digest
+
+
+def synthesize(root, names, tags, shared_layers, layers, layer_size, seed):
+    """Create an image tree of `names` x `tags` images in `root`.
+
+    Each image has a unique configuration and layer, plus `layers` layers
+    picked from a pool of `shared_layers` layers (hard linked between
+    images).
+    """
+    rand = random.Random(seed)
+    pool = os.path.join(root, '.pool')
+    os.makedirs(pool)
+    shared = [
+        write_blob(pool, rand.getrandbits(8 * layer_size).to_bytes(
+            layer_size, 'little'
+        ))
+        for _ in range(shared_layers)
+    ]
+
+    for name_index in range(names):
+        name = 'image-{:04d}'.format(name_index)
+        for tag_index in range(tags):
+            tag = '1.{}.0'.format(tag_index)
+            directory = os.path.join(root, name, tag)
+            os.makedirs(directory)
+
+            config = write_blob(
+                directory, '{}:{}'.format(name, tag).encode('utf-8')
+            )
+            own = write_blob(
+                directory, '{}:{}:layer'.format(name, tag).encode('utf-8')
+            )
+            picked = rand.sample(shared, min(layers, len(shared)))
+            for digest in picked:
+                os.link(
+                    os.path.join(pool, digest), os.path.join(directory, digest)
+                )
+
+            manifest = {
+                'schemaVersion': 2,
+                'mediaType': REGISTRY.MANIFEST_MEDIA_TYPE,
+                'config': {
+                    'mediaType': CONFIG_MEDIA_TYPE,
+                    'size': 0,
+                    'digest': 'sha256:{}'.format(config),
+                },
+                'layers': [
+                    {
+                        'mediaType': LAYER_MEDIA_TYPE,
+                        'size': 0,
+                        'digest': 'sha256:{}'.format(digest),
+                    }
+                    for digest in picked + [own]
+                ],
+            }
+            with open(os.path.join(directory, 'manifest.json'), 'w') as fd:
+                json.dump(manifest, fd)
+            with open(os.path.join(directory, 'version'), 'w') as fd:
+                fd.write('Directory Transport Version: 1.1\n')
+
+    shutil.rmtree(pool)
+
+
+def generate(root, name_prefix, index, static_dir):
+    """Generate the configuration, returning it with generation metrics."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    config = ''.join(REGISTRY.create_config(
+        root, root, name_prefix, index=index, static_dir=static_dir
+    ))
+    duration = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return config, {
+        'seconds': duration,
+        'peak_memory_bytes': peak,
+        'output_bytes': len(config.encode('utf-8')),
+        'locations': config.count('\nlocation '),
+    }
+
+
+LOCATION_RE = re.compile(
+    r'^location (?P<kind>=|~) "?(?P<path>[^" ]+)"? \{\n(?P<body>.*?)^\}',
+    re.MULTILINE | re.DOTALL,
+)
+
+
+class Location:
+    """A location of the generated configuration, as understood by the
+    stand-in server (only the directives used by the generator)."""
+
+    def __init__(self, kind, path, body):
+        self.regex = re.compile(path) if kind == '~' else None
+        self.path = path
+        self.directives = {}
+        self.headers = []
+        for line in body.strip().splitlines():
+            directive, _, value = line.strip().rstrip(';').partition(' ')
+            if directive == 'add_header':
+                header, value = value.split(' ', 1)
+                self.headers.append((header.strip("'"), value.strip("'")))
+            else:
+                self.directives[directive] = value
+
+    def resolve(self, match):
+        """Return `(status, headers, path or body)` for a request."""
+        if 'return' in self.directives:
+            status, _, body = self.directives['return'].partition(' ')
+            if status.startswith('3'):
+                return int(status), [('Location', body)], b''
+            return int(status), [], body.strip("'").encode('utf-8')
+
+        alias = self.directives['alias']
+        if 'try_files' not in self.directives:
+            return 200, self.headers, alias
+
+        for candidate in self.directives['try_files'].split()[:-1]:
+            if match is not None and match.groups():
+                candidate = candidate.replace('$1', match.group(1))
+            path = os.path.join(alias, candidate)
+            if os.path.isfile(path):
+                return 200, self.headers, path
+        return 404, [], b''
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """Serve requests following the locations of a generated configuration."""
+
+    exact = {}
+    regexes = []
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        self._serve(with_body=True)
+
+    def do_HEAD(self):  # pylint: disable=invalid-name
+        self._serve(with_body=False)
+
+    def _serve(self, with_body):
+        path = self.path.split('?', 1)[0]
+        location, match = self.exact.get(path), None
+        if location is None:
+            for candidate in self.regexes:
+                match = candidate.regex.search(path)
+                if match:
+                    location = candidate
+                    break
+        if location is None:
+            status, headers, payload = 404, [], b''
+        else:
+            status, headers, payload = location.resolve(match)
+
+        if isinstance(payload, str):
+            stat = os.stat(payload)
+            headers = headers + [
+                ('ETag', '"{:x}-{:x}"'.format(
+                    int(stat.st_mtime), stat.st_size
+                )),
+            ]
+            with open(payload, 'rb') as fd:
+                payload = fd.read()
+
+        self.send_response(status)
+        for header, value in headers:
+            self.send_header(header, value)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        if with_body:
+            self.wfile.write(payload)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+class StandInServer(http.server.ThreadingHTTPServer):
+    """Threaded HTTP server, accepting bursts of concurrent connections."""
+
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def serve(config):
+    """Start a stand-in server for `config`, returning it."""
+    exact, regexes = {}, []
+    for match in LOCATION_RE.finditer(config):
+        location = Location(
+            match.group('kind'), match.group('path'), match.group('body')
+        )
+        if location.regex is None:
+            exact[location.path] = location
+        else:
+            regexes.append(location)
+
+    handler = type(
+        'Handler', (StandInHandler,), {'exact': exact, 'regexes': regexes}
+    )
+    server = StandInServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def fetch(url, method='GET'):
+    """Fetch an URL, returning its status, body and latency."""
+    request = urllib.request.Request(url, method=method)
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request) as response:
+            status, body = response.status, response.read()
+    except urllib.error.HTTPError as exc:
+        status, body = exc.code, b''
+    return status, body, time.perf_counter() - start
+
+
+def percentile(values, rank):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(rank * (len(values) - 1))))]
+
+
+def pull(base_url, images, concurrency):
+    """Pull the given images concurrently, returning latency metrics."""
+    def pull_image(image):
+        latencies, errors = [], 0
+        status, body, latency = fetch('{}/manifests/{}'.format(
+            base_url.format(name=image[0]), image[1]
+        ))
+        latencies.append(('manifest', latency))
+        if status != 200:
+            return latencies, 1
+        manifest = json.loads(body.decode('utf-8'))
+        for entry in [manifest['config']] + manifest['layers']:
+            status, _, latency = fetch('{}/blobs/{}'.format(
+                base_url.format(name=image[0]), entry['digest']
+            ))
+            latencies.append(('blob', latency))
+            errors += status != 200
+        return latencies, errors
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(pull_image, images))
+    wall_clock = time.perf_counter() - start
+
+    metrics = {
+        'images': len(images),
+        'concurrency': concurrency,
+        'wall_clock_seconds': wall_clock,
+        'errors': sum(errors for _, errors in results),
+    }
+    for kind in ('manifest', 'blob'):
+        values = [
+            latency
+            for latencies, _ in results
+            for (entry_kind, latency) in latencies
+            if entry_kind == kind
+        ]
+        metrics[kind] = {
+            'requests': len(values),
+            'p50': percentile(values, 0.5),
+            'p95': percentile(values, 0.95),
+            'p99': percentile(values, 0.99),
+            'max': max(values) if values else None,
+        }
+    return metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--names', type=int, default=200)
+    parser.add_argument('--tags', type=int, default=10)
+    parser.add_argument('--shared-layers', type=int, default=50)
+    parser.add_argument('--layers', type=int, default=5,
+                        help='shared layers per image')
+    parser.add_argument('--layer-size', type=int, default=1024)
+    parser.add_argument('--pulls', type=int, default=200,
+                        help='number of images to pull (0 to skip)')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--static-dir', default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep', metavar='DIR', default=None,
+                        help='synthesize the tree in DIR and keep it')
+    args = parser.parse_args()
+
+    root = args.keep or tempfile.mkdtemp(prefix='static-container-registry-')
+    try:
+        start = time.perf_counter()
+        synthesize(
+            root, args.names, args.tags, args.shared_layers, args.layers,
+            args.layer_size, args.seed,
+        )
+        results = {
+            'tree': {
+                'names': args.names,
+                'tags': args.tags,
+                'shared_layers': args.shared_layers,
+                'synthesis_seconds': time.perf_counter() - start,
+            },
+        }
+
+        index = {}
+        config, results['generation_cold'] = generate(
+            root, 'bench/', index, args.static_dir
+        )
+        _, results['generation_indexed'] = generate(
+            root, 'bench/', index, args.static_dir
+        )
+
+        if args.pulls:
+            server = serve(config)
+            try:
+                rand = random.Random(args.seed)
+                images = [
+                    ('image-{:04d}'.format(rand.randrange(args.names)),
+                     '1.{}.0'.format(rand.randrange(args.tags)))
+                    for _ in range(args.pulls)
+                ]
+                results['pulls'] = pull(
+                    'http://127.0.0.1:{}/v2/bench/{{name}}'.format(
+                        server.server_address[1]
+                    ),
+                    images, args.concurrency,
+                )
+            finally:
+                server.shutdown()
+    finally:
+        if not args.keep:
+            shutil.rmtree(root)
+
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+    if results.get('pulls', {}).get('errors'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,12 @@
 
 set -ue
 
-python3 /static-container-registry.py /var/lib/images > /var/run/static-container-registry.conf
+INDEX=/var/lib/images/.static-container-registry-index.json
+
+if [ -f "$INDEX" ]; then
+        python3 /static-container-registry.py --index "$INDEX" /var/lib/images > /var/run/static-container-registry.conf
+else
+        python3 /static-container-registry.py /var/lib/images > /var/run/static-container-registry.conf
+fi
 
 exec "$@"
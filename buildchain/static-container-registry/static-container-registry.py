@@ -3,6 +3,7 @@
 import sys
 import os.path
 import json
+import gzip
 import hashlib
 import logging
 import argparse
@@ -37,11 +38,122 @@ location @404_tag {{
 
 
 MANIFEST_JSON = 'manifest.json'
+MANIFEST_MEDIA_TYPE = 'application/vnd.docker.distribution.manifest.v2+json'
 
+INDEX_VERSION = 3
+# Name of the index shipped along with the images (at the root of the image
+# files), used by the container entrypoint.
+INDEX_FILE = '.static-container-registry-index.json'
 
-def find_images(root):
+
+def load_index(path):
+    """Load a manifest digests index, as written by `save_index`.
+
+    Returns an empty index if the file doesn't exist or is invalid.
+    """
+    try:
+        with open(path, 'r') as fd:
+            data = json.load(fd)
+    except (IOError, OSError, ValueError) as exc:
+        LOGGER.info('Unable to load index from %s: %s', path, exc)
+        return {}
+
+    if not isinstance(data, dict) or data.get('version') != INDEX_VERSION:
+        LOGGER.info('Ignoring index %s: unsupported version', path)
+        return {}
+
+    return data.get('manifests', {})
+
+
+def save_index(index, path):
+    """Save a manifest digests index."""
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'w') as fd:
+        json.dump(
+            {'version': INDEX_VERSION, 'manifests': index},
+            fd, sort_keys=True,
+        )
+    os.replace(tmp, path)
+
+
+def read_manifest(path):
+    """Hash and validate a manifest in a single read.
+
+    Returns a `(digest, blobs)` tuple, with the hex digest of the manifest
+    and the hex digests of the blobs (configuration and layers) it
+    references, or `None` if it's not a valid image manifest.
+    """
+    with open(path, 'rb') as fd:
+        LOGGER.info('Attempting to load JSON data from %s', path)
+        content = fd.read()
+
+    try:
+        data = json.loads(content.decode('utf-8'))
+    except ValueError:
+        LOGGER.info('Failed to decode JSON from %s', path)
+        return None
+
+    if not data or not isinstance(data, dict):
+        return None
+
+    if data.get('schemaVersion') != 2:
+        LOGGER.info('Invalid schemaVersion in %s', path)
+        return None
+
+    if data.get('mediaType') != MANIFEST_MEDIA_TYPE:
+        LOGGER.info('Invalid mediaType in %s', path)
+        return None
+
+    try:
+        blobs = [
+            entry['digest'].split(':', 1)[1]
+            for entry in [data['config']] + list(data['layers'])
+        ]
+    except (KeyError, IndexError, TypeError, AttributeError):
+        LOGGER.info('Invalid blob references in %s', path)
+        return None
+
+    return (hashlib.sha256(content).hexdigest(), blobs)
+
+
+def write_json(path, payload):
+    """Write a JSON document, along with its gzip-compressed version.
+
+    The compressed file is meant to be served by nginx `gzip_static`, so
+    its timestamp is fixed to keep it reproducible.
+    """
+    content = json.dumps(payload, sort_keys=True).encode('utf-8')
+
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    with open(path, 'wb') as fd:
+        fd.write(content)
+
+    with open('{}.gz'.format(path), 'wb') as fd:
+        with gzip.GzipFile(
+                filename='', mode='wb', fileobj=fd, mtime=0) as gz:
+            gz.write(content)
+
+
+def find_images(root, index=None):
+    """Find the images in `root`.
+
+    Yields `(name, tag, digest, blobs, present)` tuples, where `present` are
+    the referenced blobs found in the image directory.
+
+    If an `index` (as loaded by `load_index`) is provided, images whose
+    manifest size and modification time, and directory modification time
+    (which changes when blobs are added or removed), match their index entry
+    are not read nor listed again, and the index is updated with the images
+    read.
+    """
     LOGGER.info('Finding images in %s', root)
 
+    if index is None:
+        index = {}
+    seen = set()
+
     for name in os.listdir(root):
         curr = os.path.join(root, name)
         LOGGER.info('Looking into %s for tags of %s', curr, name)
@@ -49,6 +161,10 @@ def find_images(root):
         if not os.path.isdir(curr):
             continue
 
+        # Not a valid repository name (e.g. static files directory)
+        if name.startswith(('.', '_')):
+            continue
+
         for tag in os.listdir(curr):
             curr = os.path.join(root, name, tag)
 
@@ -60,41 +176,108 @@ def find_images(root):
 
             manifest = os.path.join(curr, MANIFEST_JSON)
 
-            if not os.path.isfile(manifest):
+            try:
+                stat = os.stat(manifest)
+                dir_stat = os.stat(curr)
+            except OSError:
                 LOGGER.info('No manifest file at %s', manifest)
                 continue
 
-            with open(manifest, 'r') as fd:
-                LOGGER.info('Attempting to load JSON data from %s', manifest)
-                try:
-                    data = json.load(fd)
-                except json.JSONDecodeError:
-                    LOGGER.info('Failed to decode JSON from %s', manifest)
-                    data = None
-
-            if not data:
+            key = '{}/{}'.format(name, tag)
+            seen.add(key)
+            # Modification times are truncated to the second, since that's
+            # all some filesystems (e.g. ISO9660) preserve.
+            entry = {
+                'size': stat.st_size,
+                'mtime': int(stat.st_mtime),
+                'dir_mtime': int(dir_stat.st_mtime),
+            }
+            cached = index.get(key)
+
+            if cached and all(cached.get(k) == v for k, v in entry.items()):
+                LOGGER.info('Using indexed digest for %s', manifest)
+                digest = cached['digest']
+                blobs = cached['blobs']
+                present = cached['present']
+            else:
+                result = read_manifest(manifest)
+                digest, blobs = result if result else (None, None)
+                present = sorted(
+                    set(blobs).intersection(os.listdir(curr))
+                ) if blobs else None
+                entry.update({
+                    'digest': digest, 'blobs': blobs, 'present': present,
+                })
+                index[key] = entry
+
+            if digest is None:
                 continue
 
-            if data.get('schemaVersion') != 2:
-                LOGGER.info('Invalid schemaVersion in %s', manifest)
-                continue
+            LOGGER.info('Found image %s:%s in %s', name, tag, curr)
+            yield (name, tag, digest, blobs, present)
 
-            if data.get('mediaType') != \
-                    'application/vnd.docker.distribution.manifest.v2+json':
-                LOGGER.info('Invalid mediaType in %s', manifest)
-                continue
+    for key in set(index) - seen:
+        del index[key]
 
-            LOGGER.info('Found image %s:%s in %s', name, tag, curr)
-            yield (name, tag)
 
+def create_config(root, server_root, name_prefix, with_constants=True,
+                  index=None, static_dir=None):
+    """Generate the nginx configuration serving the images in `root`.
 
-def create_config(root, server_root, name_prefix, with_constants=True):
+    If `static_dir` is set, tag lists and the catalog are written as JSON
+    files, along with gzip-compressed versions, in this directory of `root`,
+    and served from there (with `Content-Length`, `ETag` and conditional
+    requests support) instead of being inlined in the configuration.
+    The catalog file is written even without the constants, so that the
+    catalogs of several configurations included in the same server (which
+    can't all define the `/v2/_catalog` location) can be merged.
+    """
     if with_constants:
         yield CONSTANTS
 
     images = {}
-    for (name, tag) in find_images(root):
-        images.setdefault(name, set()).add(tag)
+    for (name, tag, digest, blobs, present) in find_images(root, index):
+        images.setdefault(name, {})[tag] = (digest, blobs, present)
+
+    catalog = {
+        'repositories': [
+            '{}{}'.format(name_prefix.lstrip('/'), name)
+            for name in sorted(images)
+        ],
+    }
+
+    if static_dir:
+        write_json(os.path.join(root, static_dir, 'catalog.json'), catalog)
+
+    if with_constants:
+        if static_dir:
+            yield '''
+location = /v2/_catalog {{
+    alias {server_root:s}/{static_dir:s}/catalog.json;
+    types {{ }} default_type "application/json";
+    gzip_static on;
+}}
+'''.format(
+        server_root=server_root,
+        static_dir=static_dir,
+    )
+        else:
+            yield '''
+location = /v2/_catalog {{
+    types {{ }} default_type "application/json";
+    return 200 '{payload:s}';
+}}
+'''.format(
+        payload=json.dumps(catalog),
+    )
+
+    # Location of each blob, as a `(name, tag)` image directory containing
+    # it: blobs are served from there for all images referencing them.
+    blob_locations = {}
+    for (name, tags) in sorted(images.items()):
+        for (tag, (_, _, present)) in sorted(tags.items()):
+            for blob in present:
+                blob_locations.setdefault(blob, (name, tag))
 
     for (name, tags) in sorted(images.items()):
         tag_list = {
@@ -102,7 +285,25 @@ def create_config(root, server_root, name_prefix, with_constants=True):
             'tags': sorted(tags),
         }
 
-        yield '''
+        if static_dir:
+            write_json(
+                os.path.join(root, static_dir, name, 'tags.json'), tag_list
+            )
+
+            yield '''
+location = /v2/{name_prefix:s}{name:s}/tags/list {{
+    alias {server_root:s}/{static_dir:s}/{name:s}/tags.json;
+    types {{ }} default_type "application/json";
+    gzip_static on;
+}}
+'''.format(
+        name=name,
+        name_prefix=name_prefix.lstrip('/'),
+        server_root=server_root,
+        static_dir=static_dir,
+    )
+        else:
+            yield '''
 location = /v2/{name_prefix:s}{name:s}/tags/list {{
     types {{ }} default_type "application/json";
     return 200 '{payload:s}';
@@ -115,16 +316,7 @@ location = /v2/{name_prefix:s}{name:s}/tags/list {{
 
         seen_digests = set()
 
-        for tag in sorted(tags):
-            manifest_file = os.path.join(root, name, tag, MANIFEST_JSON)
-
-            digest = hashlib.sha256()
-
-            with open(manifest_file, 'rb') as fd:
-                for chunk in iter(lambda: fd.read(4096), b''):
-                    digest.update(chunk)
-
-            hexdigest = digest.hexdigest()
+        for (tag, (hexdigest, _, _)) in sorted(tags.items()):
 
             yield '''
 location = "/v2/{name_prefix:s}{name:s}/manifests/{tag:s}" {{
@@ -168,6 +360,31 @@ location = "/v2/{name_prefix:s}{name:s}/manifests/sha256:{digest:s}" {{
 
             seen_digests.add(hexdigest)
 
+        name_blobs = set()
+        for (_, blobs, _) in tags.values():
+            name_blobs.update(blobs)
+
+        for blob in sorted(name_blobs):
+            if blob not in blob_locations:
+                LOGGER.info('Blob %s of %s not found', blob, name)
+                continue
+
+            (blob_name, blob_tag) = blob_locations[blob]
+
+            yield '''
+location = "/v2/{name_prefix:s}{name:s}/blobs/sha256:{digest:s}" {{
+    alias {server_root:s}/{blob_name:s}/{blob_tag:s}/{digest:s};
+}}
+'''.format(
+        name=name,
+        name_prefix=name_prefix.lstrip('/'),
+        digest=blob,
+        server_root=server_root,
+        blob_name=blob_name,
+        blob_tag=blob_tag,
+    )
+
+        # Fallback for blobs not referenced by any manifest
         yield '''
 location ~ "/v2/{name_prefix:s}{name:s}/blobs/sha256:([a-f0-9]{{64}})" {{
     alias {server_root:s}/{name:s}/;
@@ -200,6 +417,18 @@ def main():
         help='root directory from where exported image files are served' \
                 ' (default: ROOT)'
     )
+    parser.add_argument(
+        '--index',
+        metavar='FILE',
+        help='index of the manifest digests, used to avoid reading' \
+                ' unchanged manifests, and updated if writable',
+    )
+    parser.add_argument(
+        '--static-dir',
+        metavar='DIR',
+        help='directory of ROOT where to write (gzip-compressed) tag lists' \
+                ' and catalog, served as static files',
+    )
     parser.add_argument(
         'root',
         metavar='ROOT',
@@ -219,9 +448,21 @@ def main():
     logging.debug('Server root: %s', server_root)
     logging.debug('Root: %s', root)
 
-    for part in create_config(root, server_root, name_prefix):
+    index = load_index(args.index) if args.index else None
+
+    parts = create_config(
+        root, server_root, name_prefix,
+        index=index, static_dir=args.static_dir,
+    )
+    for part in parts:
         sys.stdout.write(part)
 
+    if args.index:
+        try:
+            save_index(index, args.index)
+        except (IOError, OSError) as exc:
+            LOGGER.info('Unable to save index to %s: %s', args.index, exc)
+
 
 if __name__ == '__main__':
     main()
@@ -2,14 +2,25 @@
 '''
 Module for handling MetalK8s specific calls.
 '''
+import ast
+import base64
+import collections
+from datetime import datetime
+import fnmatch
+import json
 import logging
-import os.path
+from multiprocessing.pool import ThreadPool
+import os
 import re
-import socket
-import time
+import struct
 
+from salt._compat import ipaddress
 from salt.exceptions import CommandExecutionError
+from salt.ext import six
+import salt.utils.atomicfile
 import salt.utils.files
+import salt.utils.stringutils
+import salt.utils.yaml
 
 log = logging.getLogger(__name__)
 
@@ -20,18 +31,24 @@ def __virtual__():
     return __virtualname__
 
 
-def wait_apiserver(retry=10, interval=1, **kwargs):
+def wait_apiserver(retry=10, interval=1, timeout=None, max_interval=10,
+                   **kwargs):
     """Wait for kube-apiserver to respond.
 
-    Simple "retry" wrapper around the kubernetes.ping Salt execution function.
+    Probes the kube-apiserver health endpoint (using the
+    `metalk8s_kubernetes.ping` Salt execution function), retrying with an
+    exponential backoff (starting at `interval` seconds, capped to
+    `max_interval` seconds, with some jitter) until either `retry` attempts
+    were made or `timeout` seconds elapsed.
     """
-    status = __salt__['metalk8s_kubernetes.ping'](**kwargs)
-    attempts = 1
-
-    while not status and attempts < retry:
-        time.sleep(interval)
-        status = __salt__['metalk8s_kubernetes.ping'](**kwargs)
-        attempts += 1
+    status = __utils__['retry_utils.retry'](
+        lambda: __salt__['metalk8s_kubernetes.ping'](**kwargs),
+        attempts=retry,
+        timeout=timeout,
+        base=interval,
+        max_delay=max_interval,
+        jitter=0.2,
+    )
 
     if not status:
         log.error('Kubernetes apiserver failed to respond after %d attempts',
@@ -54,58 +71,332 @@ def get_etcd_endpoint():
         )
 
 
+SAN_CACHE_SIZE = 1024
+
+# Formatted SAN fields, by name, in least-recently used order
+_SAN_CACHE = collections.OrderedDict()
+
+
+def _format_san_name(name):
+    """Format a single SAN, either as an `IP:` or as a `DNS:` field.
+
+    Results are memoized in a bounded LRU cache, since the same names are
+    formatted for most certificates.
+    """
+    try:
+        result = _SAN_CACHE.pop(name)
+    except KeyError:
+        try:
+            address = ipaddress.ip_address(six.text_type(name))
+        except ValueError:
+            result = 'DNS:{}'.format(name)
+        else:
+            result = 'IP:{}'.format(address)
+
+        log.debug('SAN field for %r is "%s"', name, result)
+
+        if len(_SAN_CACHE) >= SAN_CACHE_SIZE:
+            _SAN_CACHE.popitem(last=False)
+
+    _SAN_CACHE[name] = result
+    return result
+
+
 def format_san(names):
     '''Format a `subjectAlternativeName` section of a certificate.
 
     Arguments:
         names ([str]): List if SANs, either IP addresses or DNS names
     '''
-    def format_name(name):
-        # First, try to parse as an IPv4/IPv6 address
-        for af_name in ['AF_INET', 'AF_INET6']:
-            try:
-                af = getattr(socket, af_name)
-            except AttributeError:
-                log.info('Unkown address family: %s', af_name)
-                continue
+    return ', '.join(sorted(_format_san_name(name) for name in names))
+
+
+def format_sans(names_lists):
+    '''Format several `subjectAlternativeName` sections at once.
+
+    Arguments:
+        names_lists ([[str]]): Lists of SANs, see `format_san`
+
+    Returns the list of formatted sections, in the same order.
+    '''
+    return [format_san(names) for names in names_lists]
+
+
+def sign_remote_certificates(argdics, **kwargs):
+    '''Sign several certificates at once, on behalf of a remote minion.
+
+    This is the batched version of `x509.sign_remote_certificate`, meant to
+    be called (through peer publishing) on the CA minion by
+    `metalk8s.issue_certificates`. Signing policies restrictions are
+    enforced for each certificate.
+
+    Arguments:
+        argdics (dict(str, dict)): arguments to `x509.create_certificate`,
+            for each certificate to sign, keyed by an arbitrary name
+    '''
+    if not isinstance(argdics, dict):
+        argdics = ast.literal_eval(argdics)
+
+    return dict(
+        (name, __salt__['x509.sign_remote_certificate'](argdic, **kwargs))
+        for name, argdic in argdics.items()
+    )
+
+
+def issue_certificates(certificates, ca_server, bits=2048, timeout=30):
+    '''Issue several certificates from a remote CA minion at once.
+
+    Private keys are generated locally (in parallel) for the certificates
+    without a `public_key`, then all the certificates are signed by the CA
+    minion in a single round-trip (see `metalk8s.sign_remote_certificates`).
+    If the CA minion does not answer the batched request (e.g. peer
+    publishing of this function is not allowed yet), certificates are
+    signed one at a time with `x509.create_certificate`.
+
+    Arguments:
+        certificates (dict(str, dict)): arguments to `x509.create_certificate`
+            (`signing_policy`, `CN`, `subjectAltName`...) for each certificate
+            to issue, keyed by an arbitrary name. A `subjectAltName` may be
+            given as a list of names, formatted with `metalk8s.format_sans`
+        ca_server (str): minion ID of the CA
+        bits (int): size of the generated private keys
+        timeout (int): time to wait for the CA minion to answer
+
+    Returns a dict, keyed by certificate name, of dicts with the PEM encoded
+    `certificate` and `private_key` (None if a `public_key` was provided).
+    '''
+    to_format = [
+        name for name, args in certificates.items()
+        if isinstance(args.get('subjectAltName'), (list, tuple))
+    ]
+    if to_format:
+        sans = format_sans(
+            [certificates[name]['subjectAltName'] for name in to_format]
+        )
+        certificates = dict(certificates)
+        for name, san in zip(to_format, sans):
+            certificates[name] = dict(certificates[name], subjectAltName=san)
+
+    to_generate = [
+        name for name, args in certificates.items()
+        if not args.get('public_key')
+    ]
+
+    private_keys = {}
+    if to_generate:
+        pool = ThreadPool(len(to_generate))
+        try:
+            private_keys = dict(zip(to_generate, pool.map(
+                lambda _: __salt__['x509.create_private_key'](
+                    text=True, bits=bits, verbose=False
+                ),
+                to_generate
+            )))
+        finally:
+            pool.close()
+            pool.join()
+
+    argdics = {}
+    for name, args in certificates.items():
+        argdic = dict(args)
+        # Strip newlines to make passing through as cli functions easier
+        argdic['public_key'] = salt.utils.stringutils.to_str(
+            __salt__['x509.get_public_key'](
+                private_keys.get(name) or args['public_key']
+            )
+        ).replace('\n', '')
+        argdics[name] = argdic
+
+    signed = __salt__['publish.publish'](
+        tgt=ca_server,
+        fun='metalk8s.sign_remote_certificates',
+        arg=six.text_type(argdics),
+        timeout=timeout,
+    ).get(ca_server)
+
+    if not isinstance(signed, dict):
+        log.warning(
+            'CA server %s did not answer batched signing request (%r), '
+            'falling back to one request per certificate', ca_server, signed
+        )
+        signed = dict(
+            (name, __salt__['x509.create_certificate'](
+                text=True,
+                ca_server=ca_server,
+                **dict(args, public_key=private_keys.get(name) or
+                       args['public_key'])
+            ))
+            for name, args in certificates.items()
+        )
+
+    result = {}
+    for name in certificates:
+        certificate = signed.get(name)
+        if not certificate or '-----BEGIN CERTIFICATE-----' not in certificate:
+            raise CommandExecutionError(
+                'Failed to sign certificate {}: {}'.format(name, certificate)
+            )
+        result[name] = {
+            'certificate': certificate,
+            'private_key': private_keys.get(name),
+        }
+
+    return result
+
+
+def _certificates_cache_path():
+    return os.path.join(
+        __opts__['cachedir'], 'metalk8s', 'certificates.json'
+    )
+
+
+def _read_certificates(path, cache):
+    '''Parse the certificates of a PEM file or kubeconfig, with caching.
+
+    Parsed information is cached by path, and re-used as long as the file
+    size, mtime and inode did not change.
+    '''
+    st = os.stat(path)
+    stat_key = [st.st_size, st.st_mtime, st.st_ino]
+    entry = cache.get(path)
+    if entry and entry['stat'] == stat_key:
+        return entry['certificates']
+
+    pems = []
+    if path.endswith('.crt'):
+        with salt.utils.files.fopen(path, 'r') as fd:
+            pems.append(('', fd.read()))
+    else:
+        try:
+            with salt.utils.files.fopen(path, 'r') as fd:
+                kubeconfig = salt.utils.yaml.safe_load(fd)
+            for user in kubeconfig.get('users') or []:
+                data = (user.get('user') or {}).get('client-certificate-data')
+                if data:
+                    pems.append(
+                        (user.get('name', ''), base64.b64decode(data))
+                    )
+        except Exception as exc:  # pylint: disable=broad-except
+            log.debug('Unable to read kubeconfig %s: %s', path, exc)
+
+    certificates = []
+    for user, pem in pems:
+        try:
+            info = __salt__['x509.read_certificate'](pem)
+        except Exception as exc:  # pylint: disable=broad-except
+            log.warning('Unable to parse certificate in %s: %s', path, exc)
+            continue
+        certificates.append({
+            'user': user,
+            'CN': info.get('Subject', {}).get('CN'),
+            'issuer': info.get('Issuer', {}).get('CN'),
+            'not_after': info['Not After'],
+        })
+
+    cache[path] = {'stat': stat_key, 'certificates': certificates}
+    return certificates
 
-            try:
-                # Parse
-                log.debug('Trying to parse %r as %s', name, af_name)
-                packed = socket.inet_pton(af, name)
-                # Unparse
-                log.debug('Trying to unparse %r as %s', packed, af_name)
-                unpacked = socket.inet_ntop(af, packed)
-
-                result = 'IP:{}'.format(unpacked)
-                log.debug('SAN field for %r is "%s"', name, result)
-                return result
-            except socket.error as exc:
-                log.debug('Failed to parse %r as %s: %s', name, af_name, exc)
-
-        # Fallback to assume it's a DNS name
-        result = 'DNS:{}'.format(name)
-        log.debug('SAN field for %r is "%s"', name, result)
-        return result
 
-    return ', '.join(sorted(format_name(name) for name in names))
+def certificates_expiry(root='/etc/kubernetes',
+                        patterns=('*.crt', '*.conf'),
+                        threshold=None):
+    '''List the expiry dates of all certificates under a directory.
+
+    PEM certificates (`*.crt`) and certificates embedded in kubeconfig files
+    (`*.conf`) are found with a single recursive scan of `root`. Parsed
+    certificates are cached in the minion cache directory, so only new or
+    modified files are parsed again.
+
+    Arguments:
+        root (str): directory to scan
+        patterns ([str]): file name patterns of the files to inspect
+        threshold (int): only list certificates expiring within this number
+            of days
+
+    Returns a list of certificates, sorted by expiry date, with their `path`,
+    `CN`, `issuer`, `not_after` date and `days_remaining`.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' metalk8s.certificates_expiry threshold=30
+    '''
+    if isinstance(patterns, six.string_types):
+        patterns = patterns.split(',')
+
+    try:
+        with salt.utils.files.fopen(_certificates_cache_path(), 'r') as fd:
+            cache = json.load(fd)
+    except (IOError, OSError, ValueError):
+        cache = {}
+
+    now = datetime.now()
+    result = []
+    seen = set()
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            if not any(fnmatch.fnmatch(filename, pattern)
+                       for pattern in patterns):
+                continue
+            path = os.path.join(dirpath, filename)
+            seen.add(path)
+
+            for certificate in _read_certificates(path, cache):
+                not_after = datetime.strptime(
+                    certificate['not_after'], '%Y-%m-%d %H:%M:%S'
+                )
+                days_remaining = (not_after - now).days
+                if threshold is not None and days_remaining > int(threshold):
+                    continue
+                result.append(dict(
+                    certificate, path=path, days_remaining=days_remaining
+                ))
+
+    # Forget about files which were removed
+    cache = dict((path, entry) for path, entry in cache.items()
+                 if path in seen or not path.startswith(root))
+
+    cache_path = _certificates_cache_path()
+    try:
+        if not os.path.isdir(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path))
+        with salt.utils.atomicfile.atomic_open(cache_path, 'w') as fd:
+            json.dump(cache, fd)
+    except (IOError, OSError) as exc:
+        log.warning('Unable to save certificates cache to %s: %s',
+                    cache_path, exc)
+
+    return sorted(result, key=lambda cert: (cert['not_after'], cert['path']))
 
 
 def minions_by_role(role, nodes=None):
-    '''Return a list of minion IDs in a specific role from Pillar data.
+    '''Return a sorted list of minion IDs in a specific role from Pillar data.
 
     Arguments:
         role (str): Role to match on
         nodes (dict(str, dict)): Nodes to inspect
-            Defaults to `pillar.metalk8s.nodes`.
+            Defaults to `pillar.metalk8s.nodes`, in which case the index
+            `pillar.metalk8s.nodes_by_role` (computed by the `metalk8s_nodes`
+            external pillar) is used if it matches these nodes (it does
+            not if `metalk8s.nodes` was overridden, e.g. in bootstrap).
     '''
-    nodes = nodes or __pillar__['metalk8s']['nodes']
-
-    return [
+    if not nodes:
+        nodes = __pillar__['metalk8s']['nodes']
+        by_role = __pillar__['metalk8s'].get('nodes_by_role')
+        # Cheap consistency checks: same number of nodes, and the indexed
+        # nodes returned are known
+        if by_role is not None and \
+                __pillar__['metalk8s'].get('nodes_indexed') == len(nodes):
+            minions = by_role.get(role, [])
+            if all(name in nodes for name in minions):
+                return list(minions)
+
+    return sorted(
         node
         for (node, node_info) in nodes.items()
         if role in node_info.get('roles', [])
-    ]
+    )
 
 
 def _get_product_version(info):
@@ -158,6 +449,77 @@ def product_info_from_tree(path):
         return _get_product_info(fd.read())
 
 
+ISO_SECTOR_SIZE = 2048
+ISO_PVD_SECTOR = 16
+
+
+def _iso_directory_records(fd, extent, size):
+    """Iterate over the records of an ISO9660 directory
+
+    Yields tuples `(name, extent, size, is_dir)`, where `name` has its file
+    version suffix (`;1`) stripped.
+
+    Arguments:
+        fd (file): ISO image opened in binary mode
+        extent (int): logical block of the directory
+        size (int): size of the directory, in bytes
+    """
+    fd.seek(extent * ISO_SECTOR_SIZE)
+    data = bytearray(fd.read(size))
+
+    offset = 0
+    while offset < len(data):
+        length = data[offset]
+        if length == 0:
+            # Records never cross a sector boundary, move to the next one
+            offset = (offset // ISO_SECTOR_SIZE + 1) * ISO_SECTOR_SIZE
+            continue
+        record = data[offset:offset + length]
+        name_length = record[32]
+        name = bytes(record[33:33 + name_length]).decode('ascii', 'replace')
+        yield (
+            name.split(';', 1)[0],
+            struct.unpack('<I', bytes(record[2:6]))[0],
+            struct.unpack('<I', bytes(record[10:14]))[0],
+            bool(record[25] & 0x02),
+        )
+        offset += length
+
+
+def _iso_read_file(path, filename):
+    """Read a file from the root directory of an ISO9660 image
+
+    Only the primary volume descriptor is used, so `filename` is matched
+    (case-insensitively) against ISO9660 names, e.g. `PRODUCT.TXT`.
+
+    Arguments:
+        path (str): path to an iso
+        filename (str): name of the file to read
+    """
+    with salt.utils.files.fopen(path, 'rb') as fd:
+        fd.seek(ISO_PVD_SECTOR * ISO_SECTOR_SIZE)
+        descriptor = bytearray(fd.read(ISO_SECTOR_SIZE))
+        if descriptor[0] != 1 or bytes(descriptor[1:6]) != b'CD001':
+            raise CommandExecutionError(
+                '{} is not an ISO9660 image'.format(path)
+            )
+
+        # Root directory record is embedded in the primary volume descriptor
+        root = descriptor[156:156 + 34]
+        root_extent = struct.unpack('<I', bytes(root[2:6]))[0]
+        root_size = struct.unpack('<I', bytes(root[10:14]))[0]
+
+        for name, extent, size, is_dir in _iso_directory_records(
+                fd, root_extent, root_size):
+            if not is_dir and name.upper() == filename.upper():
+                fd.seek(extent * ISO_SECTOR_SIZE)
+                return salt.utils.stringutils.to_str(fd.read(size))
+
+    raise CommandExecutionError(
+        'File {} not found in {}'.format(filename, path)
+    )
+
+
 def product_info_from_iso(path):
     """Extract product information from an iso
 
@@ -166,22 +528,53 @@ def product_info_from_iso(path):
     """
     log.debug('Reading product version from %r', path)
 
-    cmd = ' '.join([
-        'isoinfo',
-        '-x', '/PRODUCT.TXT\;1',
-        '-i', '"{}"'.format(path),
-    ])
-    result = __salt__['cmd.run_all'](cmd=cmd)
-    log.debug('Result: %r', result)
-
-    if result['retcode'] != 0:
+    try:
+        return _get_product_info(_iso_read_file(path, 'PRODUCT.TXT'))
+    except (IOError, OSError) as exc:
         raise CommandExecutionError(
-            'Failed to run isoinfo: {}'.format(
-                result.get('stderr', result['stdout'])
-            )
+            'Failed to read {}: {}'.format(path, exc)
         )
 
-    return _get_product_info(result['stdout'])
+
+def _products_cache_path():
+    return os.path.join(__opts__['cachedir'], 'metalk8s', 'products.json')
+
+
+def _load_products_cache():
+    try:
+        with salt.utils.files.fopen(_products_cache_path(), 'r') as fd:
+            return json.load(fd)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _save_products_cache(cache):
+    cache_path = _products_cache_path()
+    try:
+        if not os.path.isdir(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path))
+        with salt.utils.atomicfile.atomic_open(cache_path, 'w') as fd:
+            json.dump(cache, fd)
+    except (IOError, OSError) as exc:
+        log.warning('Unable to save products cache to %s: %s',
+                    cache_path, exc)
+
+
+def _cached_product_info_from_iso(path, cache):
+    """Extract product information from an iso, with caching
+
+    Information is cached by path, and re-used as long as the ISO size, mtime
+    and inode did not change.
+    """
+    st = os.stat(path)
+    stat_key = [st.st_size, st.st_mtime, st.st_ino]
+    entry = cache.get(path)
+    if entry and entry['stat'] == stat_key:
+        return dict(entry['info'])
+
+    info = product_info_from_iso(path)
+    cache[path] = {'stat': stat_key, 'info': info}
+    return dict(info)
 
 
 def get_products(products=None):
@@ -206,6 +599,8 @@ def get_products(products=None):
         )
 
     res = {}
+    cache = _load_products_cache()
+    previous_cache = dict(cache)
 
     for prod in products:
         if os.path.isdir(prod):
@@ -215,7 +610,7 @@ def get_products(products=None):
             version = info['version']
         elif os.path.isfile(prod):
             iso = prod
-            info = product_info_from_iso(prod)
+            info = _cached_product_info_from_iso(prod, cache)
             version = info['version']
             path = '/srv/scality/metalk8s-{0}'.format(version)
         else:
@@ -238,4 +633,7 @@ def get_products(products=None):
             )
         res.update({env_name: info})
 
+    if cache != previous_cache:
+        _save_products_cache(cache)
+
     return res
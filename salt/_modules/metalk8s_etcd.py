@@ -3,7 +3,11 @@
 Module for handling etcd client specific calls.
 '''
 import logging
+from multiprocessing.pool import ThreadPool
+import threading
+import time
 from urlparse import urlparse
+import uuid
 
 from salt.exceptions import CommandExecutionError
 
@@ -17,6 +21,28 @@ except ImportError:
 # Timeout when connection to etcd server
 TIMEOUT = 30
 
+# Timeout when probing the status of a single etcd member
+PROBE_TIMEOUT = 5
+
+# Default etcd client port
+ETCD_CLIENT_PORT = 2379
+
+# Key prefix used by the `diagnose` latency probe
+DIAGNOSE_KEY_PREFIX = '/metalk8s/diagnose/'
+
+# Upper bound of write/read probes done by `diagnose`
+DIAGNOSE_MAX_PROBES = 1000
+
+# Key written by `compact` to retrieve the current revision
+MAINTENANCE_REVISION_KEY = '/metalk8s/maintenance/revision'
+
+# Timeout when defragmenting a member (blocks the member while running)
+DEFRAG_TIMEOUT = 300
+
+# Pooled etcd clients (and their gRPC channels), keyed by connection settings
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
 
 log = logging.getLogger(__name__)
 
@@ -30,32 +56,96 @@ def __virtual__():
         return False, "python-etcd3 not available"
 
 
+def _get_client(host, ca_cert, cert_key, cert_cert,
+                port=ETCD_CLIENT_PORT, timeout=TIMEOUT):
+    """Return a pooled etcd client, re-using its gRPC channel if possible."""
+    key = (host, port, ca_cert, cert_key, cert_cert, timeout)
+    with _CLIENTS_LOCK:
+        if key not in _CLIENTS:
+            _CLIENTS[key] = etcd3.client(host=host,
+                                         port=port,
+                                         ca_cert=ca_cert,
+                                         cert_key=cert_key,
+                                         cert_cert=cert_cert,
+                                         timeout=timeout)
+        return _CLIENTS[key]
+
+
+def _get_endpoints(minion_ids):
+    """Retrieve the control plane IP of minions with a single mine lookup."""
+    if not minion_ids:
+        return {}
+
+    return __salt__['saltutil.runner'](
+        'mine.get',
+        tgt=','.join(minion_ids),
+        tgt_type='list',
+        fun='control_plane_ip'
+    )
+
+
+def _probe_status(host, port, ca_cert, cert_key, cert_cert,
+                  timeout=PROBE_TIMEOUT):
+    """Retrieve the status of an etcd member, None if it is unreachable."""
+    try:
+        return _get_client(host=host,
+                           port=port,
+                           ca_cert=ca_cert,
+                           cert_key=cert_key,
+                           cert_cert=cert_cert,
+                           timeout=timeout).status()
+    except Exception as exc:  # pylint: disable=broad-except
+        log.debug("failed to probe etcd member %s:%s: %s", host, port, exc)
+        return None
+
+
+def _probe_all(targets, ca_cert, cert_key, cert_cert, timeout=PROBE_TIMEOUT):
+    """Probe the status of several etcd members concurrently.
+
+    Arguments:
+        targets ([(str, int)]): list of (host, port) to probe
+
+    Returns the list of statuses (None for unreachable members), in the same
+    order as `targets`.
+    """
+    if not targets:
+        return []
+
+    pool = ThreadPool(len(targets))
+    try:
+        return pool.map(
+            lambda target: _probe_status(
+                host=target[0],
+                port=target[1],
+                ca_cert=ca_cert,
+                cert_key=cert_key,
+                cert_cert=cert_cert,
+                timeout=timeout,
+            ),
+            targets
+        )
+    finally:
+        pool.close()
+        pool.join()
+
+
 def _get_endpoint_up(ca_cert, cert_key, cert_cert):
     """Pick an answering etcd endpoint among all etcd servers."""
     etcd_hosts = __salt__['metalk8s.minions_by_role']('etcd')
 
     # Get host ip from etcd_hosts
-    endpoints = [
-        __salt__['saltutil.runner'](
-            'mine.get',
-            tgt=host,
-            fun='control_plane_ip'
-        )[host]
-        for host in etcd_hosts
-    ]
-
-    for endpoint in endpoints:
-        try:
-            with etcd3.client(host=endpoint,
-                              ca_cert=ca_cert,
-                              cert_key=cert_key,
-                              cert_cert=cert_cert,
-                              timeout=TIMEOUT) as etcd:
-                etcd.status()
-        except etcd3.exceptions.ConnectionFailedError:
-            pass
-        else:
-            return endpoint
+    endpoints = _get_endpoints(etcd_hosts)
+    hosts = [endpoints[host] for host in etcd_hosts if host in endpoints]
+
+    statuses = _probe_all(
+        [(host, ETCD_CLIENT_PORT) for host in hosts],
+        ca_cert=ca_cert,
+        cert_key=cert_key,
+        cert_cert=cert_cert,
+    )
+    for host, status in zip(hosts, statuses):
+        if status is not None:
+            return host
 
     raise Exception('Unable to find an available etcd member in the cluster')
 
@@ -83,12 +173,11 @@ def add_etcd_node(
             cert_cert=cert_cert
         )
 
-    with etcd3.client(host=endpoint,
-                      ca_cert=ca_cert,
-                      cert_key=cert_key,
-                      cert_cert=cert_cert,
-                      timeout=TIMEOUT) as etcd:
-        node = etcd.add_member(peer_urls)
+    etcd = _get_client(host=endpoint,
+                       ca_cert=ca_cert,
+                       cert_key=cert_key,
+                       cert_cert=cert_cert)
+    node = etcd.add_member(peer_urls)
 
     return node
 
@@ -108,14 +197,13 @@ def urls_exist_in_cluster(
             cert_cert=cert_cert
         )
 
-    with etcd3.client(host=endpoint,
-                      ca_cert=ca_cert,
-                      cert_key=cert_key,
-                      cert_cert=cert_cert,
-                      timeout=TIMEOUT) as etcd:
-        all_urls = []
-        for member in etcd.members:
-            all_urls.extend(member.peer_urls)
+    etcd = _get_client(host=endpoint,
+                       ca_cert=ca_cert,
+                       cert_key=cert_key,
+                       cert_cert=cert_cert)
+    all_urls = []
+    for member in etcd.members:
+        all_urls.extend(member.peer_urls)
 
     return set(peer_urls).issubset(all_urls)
 
@@ -133,30 +221,31 @@ def check_etcd_health(
         minion_id (str): minion id of an etcd node
     '''
     # Get host ip from the minion id
-    endpoint = __salt__['saltutil.runner'](
-        'mine.get', tgt=minion_id, fun='control_plane_ip'
-    )[minion_id]
+    endpoint = _get_endpoints([minion_id])[minion_id]
 
     # Get all members
-    with etcd3.client(host=endpoint,
-                      ca_cert=ca_cert,
-                      cert_key=cert_key,
-                      cert_cert=cert_cert,
-                      timeout=TIMEOUT) as etcd:
-        etcd_members = list(etcd.members)
+    etcd = _get_client(host=endpoint,
+                       ca_cert=ca_cert,
+                       cert_key=cert_key,
+                       cert_cert=cert_cert)
+    etcd_members = list(etcd.members)
 
-    unhealthy_member = 0
+    # Check all members concurrently
+    targets = []
     for member in etcd_members:
         etcd_url = urlparse(member.client_urls[0])
-        try:
-            with etcd3.client(host=etcd_url.hostname,
-                              port=etcd_url.port,
-                              ca_cert=ca_cert,
-                              cert_key=cert_key,
-                              cert_cert=cert_cert,
-                              timeout=TIMEOUT) as etcd:
-                etcd.status()
-        except Exception:  # pylint: disable=broad-except
+        targets.append((etcd_url.hostname, etcd_url.port))
+
+    statuses = _probe_all(
+        targets,
+        ca_cert=ca_cert,
+        cert_key=cert_key,
+        cert_cert=cert_cert,
+    )
+
+    unhealthy_member = 0
+    for member, status in zip(etcd_members, statuses):
+        if status is None:
             log.debug(
                 "failed to check the health of member %s", member.name
             )
@@ -169,3 +258,299 @@ def check_etcd_health(
         raise CommandExecutionError("cluster is degraded")
     else:
         return "cluster is healthy"
+
+
+def _percentiles(values, percents=(50, 90, 99)):
+    """Compute nearest-rank percentiles (and max) of a list of values."""
+    if not values:
+        return {}
+
+    ordered = sorted(values)
+    result = {}
+    for percent in percents:
+        rank = max(int(round(percent / 100.0 * len(ordered))), 1)
+        result['p{}'.format(percent)] = ordered[rank - 1]
+    result['max'] = ordered[-1]
+    return result
+
+
+def _latency_probe(etcd, probes, value_size):
+    """Time `probes` write/read round-trips under a dedicated key prefix."""
+    prefix = '{}{}/'.format(DIAGNOSE_KEY_PREFIX, uuid.uuid4().hex)
+    value = b'x' * value_size
+    writes = []
+    reads = []
+
+    try:
+        for index in range(probes):
+            key = '{}{}'.format(prefix, index)
+
+            start = time.time()
+            etcd.put(key, value)
+            writes.append(time.time() - start)
+
+            start = time.time()
+            etcd.get(key)
+            reads.append(time.time() - start)
+    finally:
+        etcd.delete_prefix(prefix)
+
+    return {
+        'probes': probes,
+        'value_size': value_size,
+        'write': _percentiles(writes),
+        'read': _percentiles(reads),
+    }
+
+
+def diagnose(
+        minion_id=None,
+        endpoint=None,
+        probes=50,
+        value_size=256,
+        ca_cert='/etc/kubernetes/pki/etcd/ca.crt',
+        cert_key='/etc/kubernetes/pki/etcd/salt-master-etcd-client.key',
+        cert_cert='/etc/kubernetes/pki/etcd/salt-master-etcd-client.crt'):
+    '''Gather performance diagnostics of the `etcd` cluster.
+
+    Retrieve the status of each member (version, database size, raft index
+    and its lag behind the most advanced member, leadership), then run a
+    bounded write/read latency probe through the selected endpoint, under a
+    dedicated key prefix (removed afterwards). Since each write is committed
+    through raft and synced to disk on a quorum of members, the write
+    latency percentiles are a good indicator of slow disks.
+
+    Arguments:
+        minion_id (str): minion id of the etcd node to connect to
+        endpoint (str): etcd server to connect to (IP is expected, not URL),
+                        takes precedence over `minion_id`
+        probes (int): number of write/read round-trips (at most 1000)
+        value_size (int): size, in bytes, of the values written
+        ca_cert, cert_key, cert_cert (str): client TLS material, set them to
+                        an empty value to use an insecure connection
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-call metalk8s_etcd.diagnose endpoint=127.0.0.1 \\
+            ca_cert= cert_key= cert_cert=
+    '''
+    ca_cert = ca_cert or None
+    cert_key = cert_key or None
+    cert_cert = cert_cert or None
+    probes = int(probes)
+    if not 0 < probes <= DIAGNOSE_MAX_PROBES:
+        raise CommandExecutionError(
+            'Number of probes must be between 1 and {}'.format(
+                DIAGNOSE_MAX_PROBES
+            )
+        )
+
+    if not endpoint:
+        if minion_id:
+            endpoint = _get_endpoints([minion_id])[minion_id]
+        else:
+            endpoint = _get_endpoint_up(
+                ca_cert=ca_cert,
+                cert_key=cert_key,
+                cert_cert=cert_cert
+            )
+
+    etcd = _get_client(host=endpoint,
+                       ca_cert=ca_cert,
+                       cert_key=cert_key,
+                       cert_cert=cert_cert)
+    etcd_members = list(etcd.members)
+
+    targets = []
+    for member in etcd_members:
+        etcd_url = urlparse(member.client_urls[0])
+        targets.append((etcd_url.hostname, etcd_url.port))
+
+    statuses = _probe_all(
+        targets,
+        ca_cert=ca_cert,
+        cert_key=cert_key,
+        cert_cert=cert_cert,
+    )
+
+    max_raft_index = max(
+        [status.raft_index for status in statuses if status is not None]
+        or [0]
+    )
+
+    members = {}
+    for member, status in zip(etcd_members, statuses):
+        info = {
+            'id': member.id,
+            'client_urls': list(member.client_urls),
+            'healthy': status is not None,
+        }
+        if status is not None:
+            info.update({
+                'version': status.version,
+                'db_size': status.db_size,
+                'raft_term': status.raft_term,
+                'raft_index': status.raft_index,
+                'raft_index_lag': max_raft_index - status.raft_index,
+                'leader': (status.leader is not None
+                           and status.leader.id == member.id),
+            })
+        members[member.name] = info
+
+    return {
+        'endpoint': endpoint,
+        'members': members,
+        'latency': _latency_probe(etcd, probes, int(value_size)),
+    }
+
+
+def _get_member(etcd, name):
+    """Retrieve an etcd member by name, with its client (host, port)."""
+    for member in etcd.members:
+        if member.name == name:
+            etcd_url = urlparse(member.client_urls[0])
+            return member, (etcd_url.hostname, etcd_url.port)
+
+    raise CommandExecutionError('No etcd member named "{}"'.format(name))
+
+
+def defragment_order(
+        endpoint=None,
+        ca_cert='/etc/kubernetes/pki/etcd/ca.crt',
+        cert_key='/etc/kubernetes/pki/etcd/salt-master-etcd-client.key',
+        cert_cert='/etc/kubernetes/pki/etcd/salt-master-etcd-client.crt'):
+    '''List the `etcd` member names in defragmentation order.
+
+    Followers come first (sorted by name), the leader comes last so that
+    leadership changes are avoided as long as possible.
+
+    Arguments:
+        endpoint (str): host server in the etcd cluster
+                        IP is expected, not URL
+    '''
+    if not endpoint:
+        endpoint = _get_endpoint_up(
+            ca_cert=ca_cert,
+            cert_key=cert_key,
+            cert_cert=cert_cert
+        )
+
+    etcd = _get_client(host=endpoint,
+                       ca_cert=ca_cert,
+                       cert_key=cert_key,
+                       cert_cert=cert_cert)
+    status = etcd.status()
+    leader_id = status.leader.id if status.leader is not None else None
+
+    members = sorted(etcd.members, key=lambda member: member.name)
+    return (
+        [member.name for member in members if member.id != leader_id] +
+        [member.name for member in members if member.id == leader_id]
+    )
+
+
+def compact(
+        endpoint=None,
+        physical=True,
+        ca_cert='/etc/kubernetes/pki/etcd/ca.crt',
+        cert_key='/etc/kubernetes/pki/etcd/salt-master-etcd-client.key',
+        cert_cert='/etc/kubernetes/pki/etcd/salt-master-etcd-client.crt'):
+    '''Compact the `etcd` keyspace up to the current revision.
+
+    This module is only runnable from the salt-master on the bootstrap node.
+
+    Arguments:
+        endpoint (str): host server in the etcd cluster
+                        IP is expected, not URL
+        physical (bool): wait for the compaction to be physically applied
+    '''
+    if not endpoint:
+        endpoint = _get_endpoint_up(
+            ca_cert=ca_cert,
+            cert_key=cert_key,
+            cert_cert=cert_cert
+        )
+
+    etcd = _get_client(host=endpoint,
+                       ca_cert=ca_cert,
+                       cert_key=cert_key,
+                       cert_cert=cert_cert)
+
+    # Writing a key is the simplest way to retrieve the current revision
+    revision = etcd.put(
+        MAINTENANCE_REVISION_KEY, str(int(time.time()))
+    ).header.revision
+
+    try:
+        etcd.compact(revision, physical=physical)
+    except etcd3.exceptions.Etcd3Exception as exc:
+        # Already compacted at this revision, nothing to do
+        if 'compacted' not in str(exc):
+            raise CommandExecutionError(
+                'Failed to compact etcd to revision {}: {}'.format(
+                    revision, exc
+                )
+            )
+
+    return {'revision': revision}
+
+
+def defragment(
+        member,
+        endpoint=None,
+        ca_cert='/etc/kubernetes/pki/etcd/ca.crt',
+        cert_key='/etc/kubernetes/pki/etcd/salt-master-etcd-client.key',
+        cert_cert='/etc/kubernetes/pki/etcd/salt-master-etcd-client.crt'):
+    '''Defragment a single `etcd` member.
+
+    The member does not serve requests while being defragmented, so members
+    must be defragmented one at a time (see `defragment_order` and the
+    `metalk8s.orchestrate.etcd_maintenance` orchestrate).
+
+    This module is only runnable from the salt-master on the bootstrap node.
+
+    Arguments:
+        member (str): name of the etcd member to defragment
+        endpoint (str): host server in the etcd cluster
+                        IP is expected, not URL
+
+    Returns the database size of the member before and after the
+    defragmentation, and the reclaimed size (in bytes).
+    '''
+    if not endpoint:
+        endpoint = _get_endpoint_up(
+            ca_cert=ca_cert,
+            cert_key=cert_key,
+            cert_cert=cert_cert
+        )
+
+    etcd = _get_client(host=endpoint,
+                       ca_cert=ca_cert,
+                       cert_key=cert_key,
+                       cert_cert=cert_cert)
+    _, (host, port) = _get_member(etcd, member)
+
+    member_etcd = _get_client(host=host,
+                              port=port,
+                              ca_cert=ca_cert,
+                              cert_key=cert_key,
+                              cert_cert=cert_cert,
+                              timeout=DEFRAG_TIMEOUT)
+
+    db_size_before = member_etcd.status().db_size
+    member_etcd.defragment()
+    db_size_after = member_etcd.status().db_size
+
+    log.info(
+        'Defragmented etcd member %s: %d bytes reclaimed',
+        member, db_size_before - db_size_after
+    )
+
+    return {
+        'member': member,
+        'db_size_before': db_size_before,
+        'db_size_after': db_size_after,
+        'reclaimed': db_size_before - db_size_after,
+    }
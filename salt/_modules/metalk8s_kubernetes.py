@@ -269,20 +269,119 @@ def _cleanup(**kwargs):
                     log.exception(err)
 
 
-def ping(**kwargs):
+# Pooled API clients, keyed by (kubeconfig, context), so that repeated
+# health checks (e.g. from `metalk8s.wait_apiserver`) reuse connections
+_API_CLIENTS = {}
+
+
+def _get_api_client(cfg):
+    '''
+    Return a (pooled) API client for the connection setup by `_setup_conn`
+    '''
+    kubeconfig = cfg.get('kubeconfig')
+    if not kubeconfig or os.path.basename(kubeconfig).startswith(
+            'salt-kubeconfig-'):
+        # Temporary kubeconfig, removed by `_cleanup`, do not pool it
+        return kubernetes.client.ApiClient()
+
+    key = (kubeconfig, cfg.get('context'))
+    if key not in _API_CLIENTS:
+        _API_CLIENTS[key] = kubernetes.client.ApiClient()
+    return _API_CLIENTS[key]
+
+
+# Connections (keyed by kubeconfig and context) to API servers which do not
+# expose the `/readyz` endpoint
+_READYZ_UNSUPPORTED = set()
+
+
+def _readyz_unsupported(value=None, **kwargs):
+    '''
+    Get (or set, if `value` is True) whether `/readyz` is not supported
+    '''
+    key = (
+        kwargs.get('kubeconfig') or
+        __salt__['config.option']('kubernetes.kubeconfig'),
+        kwargs.get('context') or
+        __salt__['config.option']('kubernetes.context'),
+    )
+    if value:
+        _READYZ_UNSUPPORTED.add(key)
+    return key in _READYZ_UNSUPPORTED
+
+
+def _health_probe(path, timeout, **kwargs):
+    '''
+    Query a health endpoint of the kubernetes API server
+
+    Returns the response body, raises on connection failure or if the API
+    server does not answer with a 2xx status.
+    '''
+    cfg = _setup_conn(**kwargs)
+    try:
+        api_client = _get_api_client(cfg)
+        response = api_client.call_api(
+            path, 'GET',
+            auth_settings=['BearerToken'],
+            _return_http_data_only=True,
+            _preload_content=False,
+            _request_timeout=timeout,
+        )
+        return response.data
+    finally:
+        _cleanup(**cfg)
+
+
+def ping(connect_timeout=2, read_timeout=5, details=False, **kwargs):
     '''
     Checks connections with the kubernetes API server.
     Returns True if the connection can be established, False otherwise.
 
+    The API server `/readyz` endpoint is queried (falling back to `/healthz`
+    for API servers not exposing it), so the cost of this check does not
+    depend on the cluster size.
+
+    connect_timeout
+        Timeout, in seconds, to establish the connection
+
+    read_timeout
+        Timeout, in seconds, to receive the response
+
+    details
+        If True, return a dict with the `status`, the `latency` (in seconds)
+        and the `endpoint` queried, instead of a boolean
+
     CLI Example:
         salt '*' kubernetes.ping
+        salt '*' kubernetes.ping details=True
     '''
+    timeout = (connect_timeout, read_timeout)
+    endpoint = '/healthz' if _readyz_unsupported(**kwargs) else '/readyz'
+
     status = True
+    start = time.time()
     try:
-        nodes(**kwargs)
-    except CommandExecutionError:
+        try:
+            _health_probe(endpoint, timeout, **kwargs)
+        except ApiException as exc:
+            if exc.status != 404 or endpoint == '/healthz':
+                raise
+            # API server too old to expose `/readyz`
+            _readyz_unsupported(True, **kwargs)
+            endpoint = '/healthz'
+            start = time.time()
+            _health_probe(endpoint, timeout, **kwargs)
+    except (ApiException, HTTPError, CommandExecutionError) as exc:
+        log.debug('Kubernetes API server did not answer on %s: %s',
+                  endpoint, exc)
         status = False
+    latency = time.time() - start
+
+    log.debug('Kubernetes API server ping on %s: %s (%.3fs)',
+              endpoint, status, latency)
 
+    if details:
+        return {'status': status, 'latency': latency, 'endpoint': endpoint}
     return status
 
 
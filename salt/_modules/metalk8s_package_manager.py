@@ -3,40 +3,144 @@ Describes our custom way to deal with yum packages
 so that we can support downgrade in metalk8s
 '''
 
+import functools
+import glob
+import gzip
+import hashlib
+import io
+import json
 import logging
+import os
+import xml.etree.ElementTree as ElementTree
+
+import salt.utils.atomicfile
+import salt.utils.dictupdate
+import salt.utils.files
+import salt.utils.yaml
+from salt.exceptions import CommandExecutionError
+from salt.ext.six.moves.urllib.request import urlopen  # pylint: disable=import-error
 
 log = logging.getLogger(__name__)
 
 
 __virtualname__ = 'metalk8s_package_manager'
 
+# Database whose modification means the installed packages changed
+RPMDB_PATH = '/var/lib/rpm/Packages'
+
+# Where yum stores the repositories metadata
+YUM_CACHE_DIR = '/var/cache/yum'
+
+# XML namespaces used in repositories metadata
+REPO_NS = 'http://linux.duke.edu/metadata/repo'
+COMMON_NS = 'http://linux.duke.edu/metadata/common'
+RPM_NS = 'http://linux.duke.edu/metadata/rpm'
+
 
 def __virtual__():
     return __virtualname__
 
 
-def list_pkg_deps(pkg_name, version=None, fromrepo=None):
+def _installed_packages():
     '''
-    Check dependencies related to the packages installed so that we can pass
-    this information to pkg.installed
+    Return the names of all installed packages, with a single `rpm` query
 
-    name
-        Name of the package installed
+    The result is kept in `__context__` for the duration of the run, and
+    refreshed if the RPM database changed (e.g. a package was installed).
+    '''
+    try:
+        rpmdb_mtime = os.stat(RPMDB_PATH).st_mtime
+    except OSError:
+        rpmdb_mtime = None
 
-    version
-        Version number of the package
+    cached = __context__.get('metalk8s_package_manager.installed')
+    if cached and rpmdb_mtime is not None and cached[0] == rpmdb_mtime:
+        return cached[1]
 
-        Use : salt '*' metalk8s_package_manager.list_pkg_deps kubelet 1.11.9
-    '''
-    log.info(
-        'Listing deps for "%s" with version "%s"',
-        str(pkg_name),
-        str(version)
+    package_query = __salt__['cmd.run_all'](
+        ['rpm', '-qa', '--qf', '%{NAME}\\n'],
+        python_shell=False,
     )
-    pkgs_dict = {pkg_name: version}
+    if package_query['retcode'] != 0:
+        log.error(
+            'Failed to list installed packages: %s',
+            package_query['stderr'] or package_query['stdout']
+        )
+        return None
+
+    installed = set(package_query['stdout'].split())
+    __context__['metalk8s_package_manager.installed'] = (
+        rpmdb_mtime, installed
+    )
+    return installed
+
+
+def _repo_metadata_checksum(fromrepo=None):
+    '''
+    Return a checksum of the cached metadata of the repositories to query
+
+    Returns None if the metadata is not cached yet.
+    '''
+    if fromrepo:
+        repos = fromrepo.split(',')
+    else:
+        repos = ['*']
+
+    paths = []
+    for repo in repos:
+        paths.extend(glob.glob(os.path.join(
+            YUM_CACHE_DIR, '*', '*', repo.strip(), 'repomd.xml'
+        )))
+
+    if not paths:
+        return None
+
+    hasher = hashlib.sha256()
+    for path in sorted(set(paths)):
+        hasher.update(path.encode('utf-8'))
+        with salt.utils.files.fopen(path, 'rb') as fd:
+            hasher.update(fd.read())
+    return hasher.hexdigest()
+
+
+def _repoquery_cache_path():
+    return os.path.join(__opts__['cachedir'], 'metalk8s', 'repoquery.json')
 
-    if not version:
-        return pkgs_dict
+
+def _load_repoquery_cache():
+    try:
+        with salt.utils.files.fopen(_repoquery_cache_path(), 'r') as fd:
+            return json.load(fd)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _save_repoquery_cache(cache):
+    path = _repoquery_cache_path()
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with salt.utils.atomicfile.atomic_open(path, 'w') as fd:
+            json.dump(cache, fd)
+    except (IOError, OSError) as exc:
+        log.warning('Unable to save repoquery cache to %s: %s', path, exc)
+
+
+def _whatrequires(pkg_name, version, fromrepo=None):
+    '''
+    Return the (recursive) reverse dependencies of a package, as a dict
+    of name -> version
+
+    Results are cached on disk, keyed by the package, its version and the
+    checksum of the repositories metadata, so `repoquery` only runs when
+    the repositories change.
+    '''
+    checksum = _repo_metadata_checksum(fromrepo)
+    key = '{}-{}@{}'.format(pkg_name, version, fromrepo or '')
+
+    cache = _load_repoquery_cache()
+    if checksum and cache.get(key, {}).get('checksum') == checksum:
+        return cache[key]['deps']
 
     command_all = [
         'repoquery', '--whatrequires', '--recursive', '--qf',
@@ -56,23 +160,319 @@ def list_pkg_deps(pkg_name, version=None, fromrepo=None):
         )
         return None
 
-    out = deps_list['stdout'].splitlines()
-    for line in out:
-        name, version = line.strip().split()
-        pkgs_dict[name] = version
+    deps = {}
+    for line in deps_list['stdout'].splitlines():
+        name, dep_version = line.strip().split()
+        deps[name] = dep_version
 
-    for key in pkgs_dict.keys():
-        package_query = __salt__['cmd.run_all'](
-            ['rpm', '-qa', key]
-        )
+    # Metadata may have been fetched by `repoquery`
+    checksum = checksum or _repo_metadata_checksum(fromrepo)
+    if checksum:
+        cache[key] = {'checksum': checksum, 'deps': deps}
+        _save_repoquery_cache(cache)
 
-        if package_query['retcode'] == 1:
-            pkgs_dict.pop(key)
-        elif package_query['retcode'] != 0:
-            log.error(
-                'Failed to check if package is installed: %s',
-                deps_list['stderr'] or deps_list['stdout']
+    return deps
+
+
+def _repo_config(saltenv):
+    '''
+    Return the `repo` configuration for a saltenv, the same way `map.jinja`
+    does: `metalk8s/defaults.yaml` from this saltenv, overridden by pillar
+    '''
+    defaults = __salt__['cp.get_file_str'](
+        'salt://metalk8s/defaults.yaml', saltenv=saltenv
+    )
+    if not defaults:
+        raise CommandExecutionError(
+            'Unable to retrieve metalk8s/defaults.yaml from saltenv {}'.format(
+                saltenv
             )
-            return None
+        )
+    repo_config = salt.utils.yaml.safe_load(defaults).get('repo', {})
+    return salt.utils.dictupdate.update(
+        repo_config, __pillar__.get('repo', {})
+    )
+
+
+def _repositories_base_url(repo_config, saltenv):
+    '''
+    Return the base URL of the MetalK8s repositories for a saltenv, the same
+    way the yum repositories are configured (see `metalk8s.repo.offline`)
+    '''
+    if repo_config.get('local_mode'):
+        products = __salt__['metalk8s.get_products']()
+        return 'file://{}/{}'.format(
+            products[saltenv]['path'],
+            repo_config.get('relative_path', 'packages')
+        )
+
+    endpoint = __pillar__['metalk8s']['endpoints']['repositories']
+    return 'http://{}:{}/{}'.format(
+        endpoint['ip'], endpoint['ports']['http'], saltenv
+    )
+
+
+def _fetch(url):
+    '''Retrieve the content of a `file://` or `http://` URL'''
+    try:
+        response = urlopen(url)
+        try:
+            return response.read()
+        finally:
+            response.close()
+    except (IOError, OSError) as exc:
+        raise CommandExecutionError(
+            'Unable to retrieve {}: {}'.format(url, exc)
+        )
+
+
+def _parse_primary(data):
+    '''
+    Parse a `primary.xml` repository metadata file into a compact index
+
+    The index maps package names to versions (`VERSION-RELEASE`), themselves
+    mapped to the names of the capabilities the package requires and
+    provides.
+    '''
+    index = {}
+    package_tag = '{{{}}}package'.format(COMMON_NS)
+
+    for _, elem in ElementTree.iterparse(io.BytesIO(data)):
+        if elem.tag != package_tag:
+            continue
+
+        if elem.get('type') == 'rpm' and \
+                elem.findtext('{{{}}}arch'.format(COMMON_NS)) != 'src':
+            name = elem.findtext('{{{}}}name'.format(COMMON_NS))
+            version = elem.find('{{{}}}version'.format(COMMON_NS))
+            fmt = elem.find('{{{}}}format'.format(COMMON_NS))
+
+            requires = set()
+            provides = set([name])
+            if fmt is not None:
+                for entry in fmt.iterfind(
+                        '{{{0}}}requires/{{{0}}}entry'.format(RPM_NS)):
+                    if not entry.get('name').startswith('rpmlib('):
+                        requires.add(entry.get('name'))
+                for entry in fmt.iterfind(
+                        '{{{0}}}provides/{{{0}}}entry'.format(RPM_NS)):
+                    provides.add(entry.get('name'))
+                for entry in fmt.iterfind('{{{}}}file'.format(COMMON_NS)):
+                    provides.add(entry.text)
+
+            index.setdefault(name, {})[
+                '{}-{}'.format(version.get('ver'), version.get('rel'))
+            ] = {
+                'requires': sorted(requires),
+                'provides': sorted(provides),
+            }
+
+        # Free memory as we go, `primary.xml` can be large
+        elem.clear()
 
-    return pkgs_dict
+    return index
+
+
+def _load_repo_index(base_url, repository):
+    '''
+    Return the index of a repository, parsing its `primary.xml.gz` only if
+    the repository metadata changed since the index was last built
+    '''
+    repo_url = '{}/{}-el7'.format(base_url, repository)
+    repomd = _fetch('{}/repodata/repomd.xml'.format(repo_url))
+    checksum = hashlib.sha256(repomd).hexdigest()
+
+    cache_path = os.path.join(
+        __opts__['cachedir'], 'metalk8s', 'repo-index',
+        '{}-{}.json'.format(repository, checksum)
+    )
+    try:
+        with salt.utils.files.fopen(cache_path, 'r') as fd:
+            return json.load(fd)
+    except (IOError, OSError, ValueError):
+        pass
+
+    location = None
+    for data in ElementTree.fromstring(repomd).iterfind(
+            '{{{}}}data'.format(REPO_NS)):
+        if data.get('type') == 'primary':
+            location = data.find(
+                '{{{}}}location'.format(REPO_NS)
+            ).get('href')
+            break
+
+    if location is None:
+        raise CommandExecutionError(
+            'No primary metadata in repository {}'.format(repo_url)
+        )
+
+    log.info('Building package index of repository %s', repo_url)
+    primary = _fetch('{}/{}'.format(repo_url, location))
+    index = _parse_primary(
+        gzip.GzipFile(fileobj=io.BytesIO(primary)).read()
+    )
+
+    try:
+        cache_dir = os.path.dirname(cache_path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # Drop indexes of previous metadata of this repository
+        for old_index in glob.glob(
+                os.path.join(cache_dir, '{}-*.json'.format(repository))):
+            os.remove(old_index)
+        with salt.utils.atomicfile.atomic_open(cache_path, 'w') as fd:
+            json.dump(index, fd)
+    except (IOError, OSError) as exc:
+        log.warning('Unable to save package index to %s: %s',
+                    cache_path, exc)
+
+    return index
+
+
+def repo_index(saltenv, repositories=None, base_url=None):
+    '''
+    Build (or load from cache) a package index of the MetalK8s repositories
+
+    The `repodata/primary.xml.gz` metadata of each repository is parsed
+    in-process into an index mapping package names to versions, themselves
+    mapped to required and provided capabilities (see `_parse_primary`).
+    Indexes are cached by repository metadata checksum.
+
+    saltenv
+        MetalK8s saltenv (e.g. `metalk8s-2.4.0`) of the repositories to use
+
+    repositories
+        Comma-separated list (or list) of repositories to index, defaults to
+        all MetalK8s repositories (`metalk8s-scality`, `metalk8s-epel`, ...)
+
+    base_url
+        URL (`http://` or `file://`) of the directory holding the
+        repositories, defaults to the one of the MetalK8s repositories for
+        `saltenv`
+
+        Use : salt '*' metalk8s_package_manager.repo_index metalk8s-2.4.0
+    '''
+    if not saltenv:
+        raise CommandExecutionError('A MetalK8s saltenv is required')
+
+    if not repositories or not base_url:
+        repo_config = _repo_config(saltenv)
+
+    if not repositories:
+        repositories = list(repo_config.get('repositories', {}))
+    elif not isinstance(repositories, list):
+        repositories = repositories.split(',')
+
+    if not base_url:
+        base_url = _repositories_base_url(repo_config, saltenv)
+
+    index = {}
+    for repository in repositories:
+        for name, versions in _load_repo_index(
+                base_url, repository.strip()).items():
+            for version, info in versions.items():
+                index.setdefault(name, {})[version] = dict(
+                    info, repository=repository.strip()
+                )
+
+    return index
+
+
+def _whatrequires_offline(pkg_name, version, saltenv, fromrepo=None):
+    '''
+    Return the (recursive) reverse dependencies of a package, as a dict
+    of name -> version, computed in-process from the repositories index
+
+    Like `repoquery --whatrequires --recursive`, the latest version of each
+    reverse dependency is returned.
+    '''
+    index = repo_index(saltenv, repositories=fromrepo)
+
+    versions = index.get(pkg_name, {})
+    matching = [
+        pkg_version for pkg_version in versions
+        if pkg_version == version or pkg_version.startswith(version + '-')
+    ]
+    if not matching:
+        log.error(
+            'Package "%s" with version "%s" not found in repositories index',
+            pkg_name, version
+        )
+        return None
+
+    version_key = functools.cmp_to_key(__salt__['pkg.version_cmp'])
+
+    # Only consider the latest version of each package
+    latest = dict(
+        (name, max(pkg_versions, key=version_key))
+        for name, pkg_versions in index.items()
+    )
+
+    provided = set(versions[max(matching, key=version_key)]['provides'])
+    deps = {}
+    changed = True
+    while changed:
+        changed = False
+        for name, pkg_version in latest.items():
+            if name in deps or name == pkg_name:
+                continue
+            info = index[name][pkg_version]
+            if provided.intersection(info['requires']):
+                deps[name] = pkg_version
+                provided.update(info['provides'])
+                changed = True
+
+    return deps
+
+
+def list_pkg_deps(pkg_name, version=None, fromrepo=None, offline=False,
+                  saltenv=None):
+    '''
+    Check dependencies related to the packages installed so that we can pass
+    this information to pkg.installed
+
+    name
+        Name of the package installed
+
+    version
+        Version number of the package
+
+    fromrepo
+        Comma-separated list of repositories to look into
+
+    offline
+        Compute dependencies in-process from the repositories index (see
+        `repo_index`) instead of running `repoquery`
+
+    saltenv
+        MetalK8s saltenv of the repositories to use, required if `offline`
+
+        Use : salt '*' metalk8s_package_manager.list_pkg_deps kubelet 1.11.9
+    '''
+    log.info(
+        'Listing deps for "%s" with version "%s"',
+        str(pkg_name),
+        str(version)
+    )
+    pkgs_dict = {pkg_name: version}
+
+    if not version:
+        return pkgs_dict
+
+    if offline:
+        deps = _whatrequires_offline(pkg_name, version, saltenv, fromrepo)
+    else:
+        deps = _whatrequires(pkg_name, version, fromrepo)
+    if deps is None:
+        return None
+    pkgs_dict.update(deps)
+
+    installed = _installed_packages()
+    if installed is None:
+        return None
+
+    return dict(
+        (name, pkg_version)
+        for name, pkg_version in pkgs_dict.items()
+        if name in installed
+    )
@@ -50,7 +50,27 @@ def node_info(node, ca_minion):
     return result
 
 
+def nodes_index(pillar_nodes):
+    """Index nodes by role and by version, with sorted lists of names."""
+    by_role = {}
+    by_version = {}
+
+    for (name, info) in pillar_nodes.items():
+        for role in info['roles']:
+            by_role.setdefault(role, []).append(name)
+        by_version.setdefault(info['version'], []).append(name)
+
+    for names in list(by_role.values()) + list(by_version.values()):
+        names.sort()
+
+    return by_role, by_version
+
+
 def ext_pillar(minion_id, pillar, kubeconfig):
+    nodes_by_role = {}
+    nodes_by_version = {}
+    nodes_indexed = 0
+
     if not os.path.isfile(kubeconfig):
         error_tplt = '{}: kubeconfig not found at {}'
         pillar_nodes = __utils__['pillar_utils.errors_to_dict']([
@@ -76,8 +96,15 @@ def ext_pillar(minion_id, pillar, kubeconfig):
             for node in node_list.items
         )
 
+        nodes_by_role, nodes_by_version = nodes_index(pillar_nodes)
+        nodes_indexed = len(pillar_nodes)
+
     return {
         'metalk8s': {
             'nodes': pillar_nodes,
+            'nodes_by_role': nodes_by_role,
+            'nodes_by_version': nodes_by_version,
+            # Number of indexed nodes, to detect a `nodes` override
+            'nodes_indexed': nodes_indexed,
         },
     }
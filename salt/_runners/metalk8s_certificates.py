@@ -0,0 +1,51 @@
+from __future__ import absolute_import, print_function, unicode_literals
+import logging
+
+import salt.client
+
+log = logging.getLogger(__name__)
+
+
+def expiry(tgt='*', threshold=None, root='/etc/kubernetes', timeout=30):
+    '''
+    Gather the certificates expiry table of all minions matching `tgt`.
+
+    Runs `metalk8s.certificates_expiry` on all minions at once, and merges
+    the results in a single table sorted by expiry date, so certificates
+    rotation can be planned cluster-wide.
+
+    CLI Example:
+    .. code-block:: bash
+
+        salt-run metalk8s_certificates.expiry threshold=30
+    '''
+    client = salt.client.get_local_client(__opts__['conf_file'])
+
+    kwarg = {'root': root}
+    if threshold is not None:
+        kwarg['threshold'] = threshold
+
+    returns = client.cmd(
+        tgt, 'metalk8s.certificates_expiry',
+        kwarg=kwarg,
+        timeout=timeout,
+    )
+
+    certificates = []
+    errors = {}
+    for minion, ret in returns.items():
+        if not isinstance(ret, list):
+            log.error('Failed to list certificates on %s: %s', minion, ret)
+            errors[minion] = ret
+            continue
+        certificates.extend(dict(cert, minion=minion) for cert in ret)
+
+    certificates.sort(
+        key=lambda cert: (cert['not_after'], cert['minion'], cert['path'])
+    )
+
+    return {
+        'result': not errors,
+        'certificates': certificates,
+        'errors': errors,
+    }
@@ -0,0 +1,183 @@
+from __future__ import absolute_import, print_function, unicode_literals
+import json
+import logging
+import os
+
+from salt.exceptions import CommandExecutionError
+import salt.utils.atomicfile
+import salt.utils.files
+
+log = logging.getLogger(__name__)
+
+BATCH_ORCHESTRATE = 'metalk8s.orchestrate.upgrade.batch'
+
+
+def _progress_path(saltenv):
+    return os.path.join(
+        __opts__['cachedir'], 'metalk8s', 'upgrade-{}.json'.format(saltenv)
+    )
+
+
+def _load_progress(saltenv):
+    try:
+        with salt.utils.files.fopen(_progress_path(saltenv), 'r') as fd:
+            return json.load(fd)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _save_progress(progress):
+    path = _progress_path(progress['saltenv'])
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with salt.utils.atomicfile.atomic_open(path, 'w') as fd:
+        json.dump(progress, fd)
+
+
+def _clear_progress(saltenv):
+    try:
+        os.remove(_progress_path(saltenv))
+    except OSError:
+        pass
+
+
+def _needs_upgrade(dest_version, node_version):
+    if node_version is None:
+        return True
+
+    node_version = str(node_version)
+    # Compare with the RPM label rules (as the package versions), for which
+    # 2.1.0-dev and 2.1.0 are equal
+    version_cmp = __salt__['salt.cmd'](
+        'pkg.version_cmp', dest_version, node_version
+    )
+    # If dest_version = 2.1.0-dev and node_version = 2.1.0, version_cmp = 0
+    # but we should not upgrade this node, while if dest_version = 2.1.0 and
+    # node_version = 2.1.0-dev, we should
+    return not (
+        version_cmp == -1 or (
+            version_cmp == 0 and dest_version != node_version
+            and '-' not in node_version
+        )
+    )
+
+
+def plan(dest_version, batch_size=1, pillar_nodes=None):
+    '''
+    Compute the batches of nodes to upgrade to `dest_version`.
+
+    Control-plane nodes (in the `master` role) are upgraded one at a time,
+    then the other nodes by batches of `batch_size` nodes, which are drained
+    at the same time. Nodes already in a version newer than `dest_version`
+    are skipped.
+
+    CLI Example:
+    .. code-block:: bash
+
+        salt-run metalk8s_upgrade.plan 2.4.0 batch_size=10
+    '''
+    batch_size = int(batch_size)
+    if batch_size < 1:
+        raise CommandExecutionError(
+            'Invalid batch size {}, must be at least 1'.format(batch_size)
+        )
+
+    if pillar_nodes is None:
+        pillar_nodes = __salt__['pillar.show_pillar']()['metalk8s']['nodes']
+
+    to_upgrade = sorted(
+        name for (name, info) in pillar_nodes.items()
+        if _needs_upgrade(dest_version, info.get('version'))
+    )
+    cp_nodes = [
+        name for name in to_upgrade
+        if 'master' in pillar_nodes[name].get('roles', [])
+    ]
+    other_nodes = [name for name in to_upgrade if name not in cp_nodes]
+
+    return [[name] for name in cp_nodes] + [
+        other_nodes[index:index + batch_size]
+        for index in range(0, len(other_nodes), batch_size)
+    ]
+
+
+def nodes(dest_version, saltenv, batch_size=1, resume=True):
+    '''
+    Upgrade all nodes to `dest_version`, following `metalk8s_upgrade.plan`.
+
+    Each batch is deployed by the `metalk8s.orchestrate.upgrade.batch`
+    orchestrate, and progress is recorded in the master cache directory
+    after each batch (one record per `saltenv`). If `resume` is True and a
+    previous upgrade to the same `dest_version`, from the same `saltenv`, was
+    interrupted, it resumes at the first incomplete batch. The record is
+    removed once the upgrade completes, so that a later run starts over.
+
+    CLI Example:
+    .. code-block:: bash
+
+        salt-run metalk8s_upgrade.nodes 2.4.0 saltenv=metalk8s-2.4.0
+    '''
+    all_nodes = __salt__['pillar.show_pillar']()['metalk8s']['nodes']
+
+    progress = _load_progress(saltenv) if resume else None
+    if progress and progress.get('saltenv') == saltenv \
+            and progress.get('dest_version') == dest_version \
+            and progress['completed'] < len(progress['batches']) \
+            and all(
+                name in all_nodes
+                for batch in progress['batches'] for name in batch
+            ):
+        log.info(
+            'Resuming upgrade to %s at batch %d/%d',
+            dest_version, progress['completed'] + 1, len(progress['batches'])
+        )
+    else:
+        progress = {
+            'saltenv': saltenv,
+            'dest_version': dest_version,
+            'batches': plan(dest_version, batch_size, pillar_nodes=all_nodes),
+            'completed': 0,
+        }
+        _save_progress(progress)
+
+    batches = progress['batches']
+    for index in range(progress['completed'], len(batches)):
+        batch = batches[index]
+        log.info(
+            'Upgrading batch %d/%d: %s',
+            index + 1, len(batches), ', '.join(batch)
+        )
+
+        ret = __salt__['state.orchestrate'](
+            BATCH_ORCHESTRATE,
+            saltenv=saltenv,
+            pillar={
+                'orchestrate': {
+                    'dest_version': dest_version,
+                    'nodes': batch,
+                    # Do not drain if we are in single node cluster
+                    'skip_draining': len(all_nodes) == 1,
+                },
+            },
+        )
+
+        if ret.get('retcode', 0) != 0:
+            raise CommandExecutionError(
+                'Failed to upgrade batch {}/{} ({}), run again to resume '
+                'the upgrade: {}'.format(
+                    index + 1, len(batches), ', '.join(batch), ret
+                )
+            )
+
+        progress['completed'] = index + 1
+        _save_progress(progress)
+
+    _clear_progress(saltenv)
+
+    return {
+        'result': True,
+        'comment': 'Upgraded {} node(s) to {} in {} batch(es)'.format(
+            sum(len(batch) for batch in batches), dest_version, len(batches)
+        ),
+        'batches': batches,
+    }
@@ -2,6 +2,8 @@
 
 from base64 import b64encode, b64decode
 from datetime import datetime, timedelta
+import hashlib
+import json
 import os
 import stat
 import yaml
@@ -13,6 +15,73 @@ def __virtual__():
     return __virtualname__
 
 
+# Minimal remaining validity of client certificates
+EXPIRATION_THRESHOLD = timedelta(days=30)
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def _fingerprintPath(filename):
+    """Path of the sidecar file caching the fingerprint of a kubeconfig."""
+    return os.path.join(
+        os.path.dirname(filename),
+        '.{0}.fingerprint'.format(os.path.basename(filename))
+    )
+
+
+def _fingerprint(ca_data, api_server, cn, expiration_date):
+    """Compute the fingerprint of a kubeconfig from its relevant fields."""
+    return hashlib.sha256('\n'.join(
+        [ca_data, api_server, cn, expiration_date]
+    ).encode('utf-8')).hexdigest()
+
+
+def _checkFingerprint(filename, expected_ca_data, expected_api_server,
+                     expected_cn):
+    """Check a kubeconfig against its cached fingerprint.
+
+    :return: True if the kubeconfig was fully validated against these
+             expectations and did not change since, False otherwise
+    """
+    try:
+        with open(_fingerprintPath(filename), 'r') as fd:
+            cached = json.load(fd)
+        file_stat = os.stat(filename)
+        return (
+            cached['mtime'] == file_stat.st_mtime and
+            cached['size'] == file_stat.st_size and
+            cached['fingerprint'] == _fingerprint(
+                expected_ca_data, expected_api_server, expected_cn,
+                cached['not_after']
+            ) and
+            datetime.strptime(cached['not_after'], DATE_FORMAT)
+            - EXPIRATION_THRESHOLD >= datetime.now()
+        )
+    except Exception:  # pylint: disable=broad-except
+        return False
+
+
+def _writeFingerprint(filename, ca_data, api_server, cn, expiration_date):
+    """Cache the fingerprint of a validated kubeconfig next to it."""
+    file_stat = os.stat(filename)
+    path = _fingerprintPath(filename)
+    try:
+        fd = os.fdopen(
+            os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w'
+        )
+        with fd:
+            json.dump({
+                'fingerprint': _fingerprint(
+                    ca_data, api_server, cn, expiration_date
+                ),
+                'not_after': expiration_date,
+                'mtime': file_stat.st_mtime,
+                'size': file_stat.st_size,
+            }, fd)
+    except (IOError, OSError):
+        pass
+
+
 def _validateKubeConfig(filename,
                         expected_ca_data,
                         expected_api_server,
@@ -24,6 +93,11 @@ def _validateKubeConfig(filename,
 
     This function is used for managed idempotency.
 
+    The full validation (involving certificate parsing and signature
+    verification) is skipped if the file did not change since it was last
+    validated against the same expectations, as recorded in a sidecar
+    fingerprint file.
+
     :return: True if the kubeconfig file matches expectation
              False otherwise (ie need to be regenerated)
     """
@@ -35,6 +109,10 @@ def _validateKubeConfig(filename,
     if stat.S_IMODE(os.stat(filename).st_mode) != 0o600:
         return False
 
+    if _checkFingerprint(filename, expected_ca_data, expected_api_server,
+                         expected_cn):
+        return True
+
     try:
         with open(filename, 'r') as fd:
             kubeconfig = yaml.safe_load(fd)
@@ -89,8 +167,8 @@ def _validateKubeConfig(filename,
     except KeyError:
         return False
     else:
-        if datetime.strptime(expiration_date, "%Y-%m-%d %H:%M:%S") \
-                - timedelta(days=30) < datetime.now():
+        if datetime.strptime(expiration_date, DATE_FORMAT) \
+                - EXPIRATION_THRESHOLD < datetime.now():
             return False
 
     if __salt__['x509.verify_signature'](
@@ -101,6 +179,10 @@ def _validateKubeConfig(filename,
             client_key, client_cert) is not True:
         return False
 
+    if not __opts__['test']:
+        _writeFingerprint(filename, expected_ca_data, expected_api_server,
+                          expected_cn, expiration_date)
+
     return True
 
 
@@ -1,15 +1,128 @@
 """Custom states for MetalK8s."""
 
-import time
+import json
+import logging
+import os
+import re
 
+import salt.utils.atomicfile
+import salt.utils.files
+import salt.utils.yaml
+
+
+log = logging.getLogger(__name__)
 
 __virtualname__ = "metalk8s"
 
+CONFIG_DIGEST_ANNOTATION = "metalk8s.scality.com/config-digest"
+
+# Jinja tags and expressions of a template.
+_JINJA_BLOCK_RE = re.compile(r"{[{%].*?[}%]}", re.DOTALL)
+# Template inputs not covered by the inputs digest of `static_pod_managed`.
+_JINJA_EXTERNAL_INPUT_RE = re.compile(
+    r"^{%-?\s*(from|import|include|extends)\b"
+    r"|\b(pillar|grains|salt|opts|saltenv|sls|slspath)\b"
+)
+
 
 def __virtual__():
     return __virtualname__
 
 
+def _digest_cache_path():
+    return os.path.join(
+        __opts__["cachedir"], "metalk8s", "static_pod_digests.json"
+    )
+
+
+def _load_digest_cache():
+    """Load the digest cache from the minion cache directory.
+
+    The cache holds the sha256 digest of config files (keyed by path, and
+    validated against their size, mtime and inode) and the inputs digest of
+    each manifest rendered by `static_pod_managed`.
+    """
+    try:
+        with salt.utils.files.fopen(_digest_cache_path(), "r") as fd:
+            cache = json.load(fd)
+    except (IOError, OSError, ValueError):
+        cache = {}
+
+    cache.setdefault("files", {})
+    cache.setdefault("manifests", {})
+    return cache
+
+
+def _save_digest_cache(cache):
+    path = _digest_cache_path()
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with salt.utils.atomicfile.atomic_open(path, "w") as fd:
+            json.dump(cache, fd)
+    except (IOError, OSError) as exc:
+        log.warning("Unable to save digest cache to %s: %s", path, exc)
+
+
+def _stat_key(path):
+    """Return the (size, mtime, inode) of a file, used to detect changes."""
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime, st.st_ino]
+
+
+def _manifest_stat_key(path):
+    """Return the stat key of a manifest, including its ownership and mode.
+
+    Unlike for config files, a change of permissions must be detected, so
+    that `file.managed` enforces them again.
+    """
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime, st.st_ino,
+            st.st_mode, st.st_uid, st.st_gid]
+
+
+def _digest_config_file(cache, path):
+    """Return the sha256 digest of `path`, re-hashing it only if changed."""
+    key = _stat_key(path)
+    entry = cache["files"].get(path)
+    if entry and entry.get("stat") == key:
+        return entry["digest"]
+
+    digest = __salt__["hashutil.digest_file"](path, checksum="sha256")
+    cache["files"][path] = {"stat": key, "digest": digest}
+    return digest
+
+
+def _current_config_digest(path):
+    """Return the config digest annotation of an existing manifest, if any."""
+    try:
+        with salt.utils.files.fopen(path, "r") as fd:
+            manifest = salt.utils.yaml.safe_load(fd)
+        return manifest["metadata"]["annotations"][CONFIG_DIGEST_ANNOTATION]
+    except Exception:  # pylint: disable=broad-except
+        return None
+
+
+def _is_self_contained_template(source, saltenv):
+    """Check if a template only depends on its own content and context.
+
+    Templates importing other templates, or reading the pillar, grains or
+    execution modules, may render differently with the same inputs digest.
+    """
+    path = __salt__["cp.cache_file"](source, saltenv)
+    if not path:
+        return False
+    try:
+        with salt.utils.files.fopen(path, "r") as fd:
+            content = fd.read()
+    except (IOError, OSError):
+        return False
+    return not any(
+        _JINJA_EXTERNAL_INPUT_RE.search(block)
+        for block in _JINJA_BLOCK_RE.findall(content)
+    )
+
+
 def static_pod_managed(name,
                        source,
                        config_files=None,
@@ -22,6 +135,15 @@ def static_pod_managed(name,
     the `metadata.annotations` section, with the key
     `metalk8s.scality.com/config-digest`.
 
+    Config file digests are cached in the minion cache directory and only
+    recomputed when the file size, mtime or inode changes.
+    If the current manifest was rendered by this state from the same inputs
+    (source template, context, config digest) and was not modified since
+    (including its ownership and mode), the template rendering is skipped
+    entirely. This only applies to self-contained templates (no imports and
+    no access to the pillar, grains or execution modules), other templates
+    are always rendered.
+
     name:
         Path to the static pod manifest.
 
@@ -49,48 +171,107 @@ def static_pod_managed(name,
         if __salt__["file.file_exists"](config_file):
             config_files.append(config_file)
 
+    cache = _load_digest_cache()
+
     config_file_digests = [
-        __salt__["hashutil.digest_file"](config_file, checksum="sha256")
+        _digest_config_file(cache, config_file)
         for config_file in config_files
     ]
     config_digest = __salt__["hashutil.md5_digest"](
         "-".join(config_file_digests)
     )
 
-    return __states__["file.managed"](
+    manifest_args = {
+        "template": kwargs.pop("template", "jinja"),
+        "user": kwargs.pop("user", "root"),
+        "group": kwargs.pop("group", "root"),
+        "mode": kwargs.pop("mode", "0600"),
+        "makedirs": kwargs.pop("makedirs", False),
+        "backup": kwargs.pop("backup", False),
+    }
+    manifest_args.update(kwargs)
+
+    saltenv = kwargs.get("saltenv", __env__)
+    source_hash = __salt__["cp.hash_file"](source, saltenv) or {}
+    inputs_digest = __salt__["hashutil.md5_digest"](json.dumps(
+        {
+            "source": source_hash.get("hsum"),
+            "saltenv": saltenv,
+            "context": context or {},
+            "config_digest": config_digest,
+            "args": manifest_args,
+        },
+        sort_keys=True,
+        default=str,
+    ))
+
+    previous = cache["manifests"].get(name)
+    if (previous
+            and _is_self_contained_template(source, saltenv)
+            and previous.get("inputs") == inputs_digest
+            and os.path.isfile(name)
+            and previous.get("stat") == _manifest_stat_key(name)
+            and _current_config_digest(name) == config_digest):
+        _save_digest_cache(cache)
+        return {
+            "name": name,
+            "changes": {},
+            "result": True,
+            "comment": "Static Pod manifest {} is up-to-date".format(name),
+        }
+
+    ret = __states__["file.managed"](
         name,
         source,
-        template=kwargs.pop("template", "jinja"),
-        user=kwargs.pop("user", "root"),
-        group=kwargs.pop("group", "root"),
-        mode=kwargs.pop("mode", "0600"),
-        makedirs=kwargs.pop("makedirs", False),
-        backup=kwargs.pop("backup", False),
         context=dict(context or {}, config_digest=config_digest),
-        **kwargs
+        **manifest_args
     )
 
+    if ret["result"] and not __opts__["test"] and os.path.isfile(name):
+        cache["manifests"][name] = {
+            "inputs": inputs_digest,
+            "stat": _manifest_stat_key(name),
+        }
+    else:
+        cache["manifests"].pop(name, None)
+    _save_digest_cache(cache)
+
+    return ret
+
 
-def module_run(name, attemps=1, sleep_time=10, **kwargs):
+def module_run(name, attemps=1, sleep_time=10, min_sleep_time=None,
+               timeout=None, **kwargs):
     """Classic module.run with a retry logic as it's buggy in salt version
     https://github.com/saltstack/salt/issues/44639
+
+    Retries use an exponential backoff with jitter, starting at
+    `min_sleep_time` seconds (defaults to `sleep_time`, i.e. no backoff) and
+    capped to `sleep_time` seconds, and stop after `attemps` attempts or
+    `timeout` seconds, whichever comes first.
     """
-    retry = attemps
+    if min_sleep_time is None:
+        min_sleep_time = sleep_time
+
     ret = {'name': name,
            'changes': {},
            'result': False,
            'comment': ''}
-    while retry > 0 and not ret['result']:
+
+    def _attempt():
         try:
-            ret = __states__["module.run"](
+            return __states__["module.run"](
                 name,
                 **kwargs
             )
         except Exception as exc:  # pylint: disable=broad-except
-            ret['comment'] = str(exc)
-
-        retry = retry - 1
-        if retry and not ret['result']:
-            time.sleep(sleep_time)
+            return dict(ret, comment=str(exc))
 
-    return ret
+    return __utils__['retry_utils.retry'](
+        _attempt,
+        attempts=attemps,
+        timeout=timeout,
+        base=min(min_sleep_time, sleep_time),
+        max_delay=sleep_time,
+        jitter=0.2,
+        condition=lambda result: result['result'],
+    )
@@ -17,16 +17,29 @@ def __virtualname__():
     return (False, "metalk8s_package_manager: no RPM-based system detected")
 
 
-def installed(name, version=None, fromrepo=None, **kwargs):
-    """Simple helper to manage package downgrade including dependencies."""
+def installed(name, version=None, fromrepo=None, offline=False, **kwargs):
+    """Simple helper to manage package downgrade including dependencies.
+
+    If `offline` is True, the dependencies are computed from the index of
+    the repositories of the current saltenv instead of using `repoquery`.
+    """
     if version is None or kwargs.get('pkgs'):
         return __states__["pkg.installed"](
             name=name, version=version, fromrepo=fromrepo, **kwargs
         )
 
     dep_list = __salt__['metalk8s_package_manager.list_pkg_deps'](
-        name, version, fromrepo
+        name, version, fromrepo, offline=offline, saltenv=__env__
     )
+    if dep_list is None:
+        return {
+            'name': name,
+            'changes': {},
+            'result': False,
+            'comment': 'Unable to list the dependencies of {} {}'.format(
+                name, version
+            ),
+        }
     pkgs = [{k: v} for k, v in dep_list.items()]
     return __states__["pkg.installed"](
         name=name, pkgs=pkgs, fromrepo=fromrepo, **kwargs
@@ -0,0 +1,116 @@
+"""
+Utility module for retrying operations with exponential backoff.
+
+The utilities contained in this module have no external dependencies, so
+they may be imported as is in any kind of Salt module.
+"""
+
+import logging
+import random
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+def backoff_delays(base=1, factor=2, max_delay=None, jitter=0):
+    """
+    Generate an infinite sequence of exponentially growing delays.
+
+    Args:
+     - base      (float): the first delay, in seconds
+     - factor    (float): the multiplier applied to the delay after each step
+     - max_delay (float): the upper bound of a single delay, if any
+     - jitter    (float): the relative amount of randomness added to each
+                          delay (0 for none, 0.5 for +/- 50%)
+
+    Yields:
+     float: the next delay to wait for, in seconds
+    """
+    delay = float(base)
+
+    while True:
+        current = delay if max_delay is None else min(delay, max_delay)
+        if jitter:
+            current = random.uniform(
+                current * (1 - jitter), current * (1 + jitter)
+            )
+        yield max(current, 0)
+        delay *= factor
+
+
+def retry(func,
+          attempts=None,
+          timeout=None,
+          base=1,
+          factor=2,
+          max_delay=None,
+          jitter=0,
+          condition=bool,
+          exceptions=(),
+          sleep=time.sleep,
+          clock=time.time):
+    """
+    Call `func` until its result satisfies `condition`.
+
+    Between two calls, wait for an exponentially growing, optionally jittered,
+    delay (see `backoff_delays`). Stops when the number of `attempts` is
+    reached or when `timeout` seconds have elapsed, whichever comes first.
+
+    Args:
+     - func        (callable): the function to call, without arguments
+     - attempts         (int): the maximum number of calls (None for no limit)
+     - timeout        (float): the deadline, in seconds from now (None for no
+                               deadline)
+     - base, factor, max_delay, jitter: see `backoff_delays`
+     - condition   (callable): predicate telling if a result is a success
+     - exceptions     (tuple): exception types considered as failed attempts
+                               (others are propagated immediately)
+     - sleep, clock (callable): time primitives (overridable for tests)
+
+    Returns:
+     the last result of `func`, successful or not
+
+    Raises:
+     the exception raised by the last attempt, if it raised one of
+     `exceptions`
+    """
+    if attempts is None and timeout is None:
+        raise ValueError('One of `attempts` or `timeout` must be provided')
+
+    deadline = None if timeout is None else clock() + timeout
+    delays = backoff_delays(
+        base=base, factor=factor, max_delay=max_delay, jitter=jitter
+    )
+    attempt = 0
+
+    while True:
+        attempt += 1
+        error = None
+        result = None
+        try:
+            result = func()
+        except exceptions as exc:  # pylint: disable=catching-non-exception
+            error = exc
+            log.debug('Attempt %d failed: %s', attempt, exc)
+        else:
+            if condition(result):
+                return result
+            log.debug('Attempt %d failed: %r', attempt, result)
+
+        if attempts is not None and attempt >= attempts:
+            break
+
+        delay = next(delays)
+        if deadline is not None:
+            remaining = deadline - clock()
+            if remaining <= 0:
+                break
+            delay = min(delay, remaining)
+
+        sleep(delay)
+
+    if error is not None:
+        raise error  # pylint: disable=raising-bad-type
+
+    return result